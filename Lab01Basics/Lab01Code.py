@@ -55,6 +55,196 @@ def decrypt_message(K, iv, ciphertext, tag):
 
     return plain.encode("utf8")
 
+from struct import pack, unpack
+
+## Bulk encryption of many small messages under one key.
+#  One Cipher object serves the whole batch, and instead of one
+#  urandom(16) IV per message, the batch draws a single random 8 byte
+#  prefix and message i uses the 12 byte nonce prefix | i. The message
+#  count is authenticated as associated data of every record, so that
+#  records cannot be dropped from the end of a batch. The results are
+#  packed in one buffer:
+#
+#  Layout: prefix (8 bytes) | count (4 bytes) | records
+#  Record: length (4 bytes) | ciphertext | tag (16 bytes)
+
+BULK_PREFIX_LEN = 8
+
+def encrypt_messages(K, messages):
+    """ Encrypt a list of messages under a key K, returning a packed buffer. """
+    if len(messages) >= 2**32:
+        raise Exception("Too many messages for one batch")
+
+    aes = Cipher("aes-128-gcm")
+    prefix = urandom(BULK_PREFIX_LEN)
+
+    count = pack("!I", len(messages))
+    out = [prefix, count]
+    for i, message in enumerate(messages):
+        ciphertext, tag = aes.quick_gcm_enc(K, prefix + pack("!I", i), message.encode("utf8"), count)
+        out += [pack("!I", len(ciphertext)), ciphertext, tag]
+    return b"".join(out)
+
+def decrypt_messages(K, packed):
+    """ Decrypt a buffer produced by encrypt_messages, returning the list of messages.
+
+        In case the decryption of any message fails, throw an exception.
+    """
+    aes = Cipher("aes-128-gcm")
+    prefix = packed[:BULK_PREFIX_LEN]
+    count, = unpack("!I", packed[BULK_PREFIX_LEN:BULK_PREFIX_LEN + 4])
+
+    messages = []
+    offset = BULK_PREFIX_LEN + 4
+    for i in range(count):
+        length, = unpack("!I", packed[offset:offset + 4])
+        ciphertext = packed[offset + 4:offset + 4 + length]
+        tag = packed[offset + 4 + length:offset + 4 + length + 16]
+        if len(tag) != 16:
+            raise Exception("Bulk: truncated buffer")
+        offset += 4 + length + 16
+
+        plain = aes.quick_gcm_dec(K, prefix + pack("!I", i), ciphertext, tag,
+                                  packed[BULK_PREFIX_LEN:BULK_PREFIX_LEN + 4])
+        messages.append(plain.decode("utf8"))
+
+    if offset != len(packed):
+        raise Exception("Bulk: trailing data")
+    return messages
+
+## Streaming AES-GCM for large messages.
+#  The message is cut into chunks of at most chunk_size bytes, each
+#  encrypted with AES-GCM under its own nonce (a random prefix, the chunk
+#  counter and a flag marking the last chunk), so chunks cannot be
+#  reordered, dropped or truncated without failing decryption. Plaintext
+#  is only written out once the tag of its chunk has been checked, and
+#  memory use is bounded by the chunk size, whatever the message size.
+#  The header is authenticated with every chunk, and decryption refuses
+#  chunk sizes above STREAM_MAX_CHUNK, so a forged header cannot make it
+#  buffer more than that.
+#
+#  Layout: prefix (7 bytes) | chunk_size (4 bytes) | frames
+#  Frame:  length (4 bytes) | ciphertext | tag (16 bytes)
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_CHUNK = 1024 * 1024
+STREAM_PREFIX_LEN = 7
+STREAM_TAG_LEN = 16
+
+def _stream_reader(source):
+    """ Returns a read(n) function over a file-like object or an iterable
+        of byte strings, returning exactly n bytes unless the source ends. """
+    if hasattr(source, "read"):
+        def read(n):
+            parts = []
+            while n > 0:
+                data = source.read(n)
+                if not data:
+                    break
+                parts.append(data)
+                n -= len(data)
+            return b"".join(parts)
+        return read
+
+    chunks = iter(source)
+    state = {"buffer": b""}
+    def read(n):
+        buffer = state["buffer"]
+        parts = [buffer[:n]]
+        have = len(parts[0])
+        buffer = buffer[n:]
+        while have < n:
+            try:
+                data = next(chunks)
+            except StopIteration:
+                break
+            parts.append(data[:n - have])
+            buffer = data[n - have:]
+            have += len(parts[-1])
+        state["buffer"] = buffer
+        return b"".join(parts)
+    return read
+
+def _stream_iv(prefix, counter, last):
+    return prefix + pack("!IB", counter, 1 if last else 0)
+
+def encrypt_stream(K, source, sink, chunk_size=STREAM_CHUNK_SIZE):
+    """ Encrypt the bytes of source (a file-like object or an iterable of
+        byte strings) under K, writing the framed ciphertext to sink.
+        Returns the number of plaintext bytes encrypted. """
+    if not 0 < chunk_size <= STREAM_MAX_CHUNK:
+        raise Exception("Stream: invalid chunk size")
+    aes = Cipher("aes-128-gcm")
+    read = _stream_reader(source)
+    prefix = urandom(STREAM_PREFIX_LEN)
+    header = prefix + pack("!I", chunk_size)
+    sink.write(header)
+
+    total = 0
+    counter = 0
+    chunk = read(chunk_size)
+    while True:
+        # Read one chunk ahead, to know whether this one is the last
+        next_chunk = read(chunk_size) if len(chunk) == chunk_size else b""
+        last = len(next_chunk) == 0
+
+        ciphertext, tag = aes.quick_gcm_enc(K, _stream_iv(prefix, counter, last), chunk,
+                                            assoc=header)
+        sink.write(pack("!I", len(ciphertext)))
+        sink.write(ciphertext)
+        sink.write(tag)
+
+        total += len(chunk)
+        counter += 1
+        if last:
+            return total
+        chunk = next_chunk
+
+def decrypt_stream(K, source, sink):
+    """ Decrypt a stream produced by encrypt_stream, writing the plaintext
+        of each chunk to sink once its tag has been verified.
+
+        Throws an exception if any chunk fails to decrypt or the stream is
+        truncated or extended. Returns the number of plaintext bytes. """
+    aes = Cipher("aes-128-gcm")
+    read = _stream_reader(source)
+
+    header = read(STREAM_PREFIX_LEN + 4)
+    if len(header) != STREAM_PREFIX_LEN + 4:
+        raise Exception("Stream: truncated header")
+    prefix = header[:STREAM_PREFIX_LEN]
+    chunk_size, = unpack("!I", header[STREAM_PREFIX_LEN:])
+    if chunk_size > STREAM_MAX_CHUNK:
+        raise Exception("Stream: chunk size too large")
+
+    total = 0
+    counter = 0
+    length_bytes = read(4)
+    while True:
+        if len(length_bytes) != 4:
+            raise Exception("Stream: truncated frame")
+        length, = unpack("!I", length_bytes)
+        if length > chunk_size:
+            raise Exception("Stream: frame larger than the chunk size")
+
+        ciphertext = read(length)
+        tag = read(STREAM_TAG_LEN)
+        if len(ciphertext) != length or len(tag) != STREAM_TAG_LEN:
+            raise Exception("Stream: truncated frame")
+
+        # The chunk is the last one if nothing follows it
+        length_bytes = read(4)
+        last = len(length_bytes) == 0
+
+        plaintext = aes.quick_gcm_dec(K, _stream_iv(prefix, counter, last), ciphertext, tag,
+                                      assoc=header)
+        sink.write(plaintext)
+
+        total += len(plaintext)
+        counter += 1
+        if last:
+            return total
+
 #####################################################
 # TASK 3 -- Understand Elliptic Curve Arithmetic
 #           - Test if a point is on a curve.
@@ -66,6 +256,61 @@ def decrypt_message(K, iv, ciphertext, tag):
 # MUST NOT USE ANY OF THE petlib.ec FUNCIONS. Only petlib.bn!
 
 from petlib.bn import Bn
+from collections import namedtuple
+
+## Field arithmetic backends.
+#  The curve arithmetic below only uses the +, -, * and % operators and
+#  field_inverse, so it runs unchanged on petlib Bn or on Python integers.
+#  Inputs are always given and returned as Bn: the public functions convert
+#  coordinates to the selected backend after validating them, and convert
+#  the result back at the end.
+
+FieldBackend = namedtuple('FieldBackend', ['name', 'to_field', 'from_field'])
+
+FIELD_BACKENDS = {
+    "bn": FieldBackend("bn", lambda v: v, lambda v: v),
+    "int": FieldBackend("int", lambda v: int(v.hex(), 16), lambda v: Bn.from_hex("%x" % v)),
+}
+
+_field_backend = FIELD_BACKENDS["bn"]
+
+def set_field_backend(name):
+    """ Selects the field arithmetic backend ("bn" or "int") for the curve functions. """
+    global _field_backend
+    if name not in FIELD_BACKENDS:
+        raise Exception("Unknown field backend: %s" % name)
+    _field_backend = FIELD_BACKENDS[name]
+
+def get_field_backend():
+    """ Returns the name of the selected field arithmetic backend. """
+    return _field_backend.name
+
+def _to_field(*values):
+    return tuple(None if v is None else _field_backend.to_field(v) for v in values)
+
+def _from_field(*values):
+    return tuple(None if v is None else _field_backend.from_field(v) for v in values)
+
+try:
+    pow(2, -1, 3)
+    def _int_inverse(v, p):
+        return pow(v, -1, p)
+except ValueError:
+    # Python < 3.8 has no modular inverse in pow
+    def _int_inverse(v, p):
+        return pow(v, p - 2, p)
+
+def field_inverse(v, p):
+    """ Returns v^-1 mod p, for Bn or integer field elements. """
+    if isinstance(p, Bn):
+        return (v % p).mod_inverse(p)
+    return _int_inverse(v % p, p)
+
+def field_inverse_fermat(v, p):
+    """ Returns v^(p-2) mod p, i.e. v^-1 mod p, as a fixed exponentiation. """
+    if isinstance(p, Bn):
+        return (v % p).mod_pow(p - 2, p)
+    return pow(v % p, p - 2, p)
 
 
 def is_point_on_curve(a, b, p, x, y):
@@ -111,7 +356,12 @@ def point_add(a, b, p, x0, y0, x1, y1):
     if not is_point_on_curve(a, b, p, x0, y0) or not is_point_on_curve(a, b, p, x1, y1):
         # Check if point any of the points are not on the curve
         raise Exception("Both points must be on the curve")
-    elif (x0 is None and y0 is None):
+    a, b, p, x0, y0, x1, y1 = _to_field(a, b, p, x0, y0, x1, y1)
+    return _from_field(*_point_add_unchecked(a, b, p, x0, y0, x1, y1))
+
+def _point_add_unchecked(a, b, p, x0, y0, x1, y1):
+    """ point_add for inputs already known to be on the curve. """
+    if (x0 is None and y0 is None):
         # Neutral elements are those when (x0, y0) + (None, None) == (x0, y0) and vice versa
         return x1, y1
     elif (x1 is None and y1 is None):
@@ -123,16 +373,9 @@ def point_add(a, b, p, x0, y0, x1, y1):
     elif ((x0 % p == x1 % p) or (y0 % p == y1 % p)):
         return None, None
     else:
-        if x0 is None or x1 is None or y0 is None or y1 is None:
-            # Use normal operations if input values have None 
-            lam = ((y1 - y0) * ((x1 - x0).mod_inverse(p))) % p
-            xr = (pow(lam, 2) - x1 - x0) % p
-            yr = (lam * ((x0 - xr)) - y0) % p
-        else:
-            # If none of the coordaintes are None we can use Bn Operations
-            lam = (y1.int_sub(y0)).int_mul((x1-x0).mod_inverse(p)) % p
-            xr = (pow(lam, 2).int_sub(x1)).mod_sub(x0, p)
-            yr = (lam.int_mul(x0.int_sub(xr))).mod_sub(y0, p)
+        lam = ((y1 - y0) * field_inverse(x1 - x0, p)) % p
+        xr = (lam * lam - x1 - x0) % p
+        yr = (lam * (x0 - xr) - y0) % p
         return xr, yr
     
 
@@ -152,15 +395,55 @@ def point_double(a, b, p, x, y):
     if not is_point_on_curve(a, b, p, x, y):
         ## Handle edge case of point not being on curve
         raise Exception("Point must be on curve")
-    elif x is None and y is None:
+    a, b, p, x, y = _to_field(a, b, p, x, y)
+    return _from_field(*_point_double_unchecked(a, b, p, x, y))
+
+def _point_double_unchecked(a, b, p, x, y):
+    """ point_double for an input already known to be on the curve. """
+    if x is None and y is None:
         ## Adding infinity point to itself results in infinity
         return x, y
     else:
-        lam = (((3 * pow(x, 2)) + a) * ((2 * y).mod_inverse(p))) % p
-        xr = ((pow(lam, 2) - 2 * x)) % p
+        lam = ((3 * x * x + a) * field_inverse(2 * y, p)) % p
+        xr = (lam * lam - 2 * x) % p
         yr = ((lam * (x - xr)) - y) % p
         return xr, yr
 
+## A point that has passed the on-curve check for the curve (a, b, p).
+#  Only build these through validate_point.
+ValidatedPoint = namedtuple('ValidatedPoint', ['a', 'b', 'p', 'x', 'y'])
+
+def validate_point(a, b, p, x, y):
+    """ Check once that (x, y) is on the curve and return a ValidatedPoint
+        that the functions below trust without checking again. """
+    if not is_point_on_curve(a, b, p, x, y):
+        raise Exception("Point must be on curve")
+    return ValidatedPoint(a, b, p, x, y)
+
+def _same_curve(P, Q):
+    return P.a == Q.a and P.b == Q.b and P.p == Q.p
+
+def validated_point_add(P, Q):
+    """ Add two ValidatedPoints of the same curve without re-validating them.
+        Unlike point_add, P + P is allowed, and computed as a doubling. """
+    if not (isinstance(P, ValidatedPoint) and isinstance(Q, ValidatedPoint)) \
+           or not _same_curve(P, Q):
+        raise Exception("Both points must be validated on the same curve")
+    a, b, p, x0, y0, x1, y1 = _to_field(P.a, P.b, P.p, P.x, P.y, Q.x, Q.y)
+    if x0 is not None and (x0, y0) == (x1, y1):
+        xr, yr = _from_field(*_point_double_unchecked(a, b, p, x0, y0))
+    else:
+        xr, yr = _from_field(*_point_add_unchecked(a, b, p, x0, y0, x1, y1))
+    return ValidatedPoint(P.a, P.b, P.p, xr, yr)
+
+def validated_point_double(P):
+    """ Double a ValidatedPoint without re-validating it. """
+    if not isinstance(P, ValidatedPoint):
+        raise Exception("Point must be validated")
+    a, b, p, x, y = _to_field(P.a, P.b, P.p, P.x, P.y)
+    xr, yr = _from_field(*_point_double_unchecked(a, b, p, x, y))
+    return ValidatedPoint(P.a, P.b, P.p, xr, yr)
+
 def point_scalar_multiplication_double_and_add(a, b, p, x, y, scalar):
     """
     Implement Point multiplication with a scalar:
@@ -176,20 +459,21 @@ def point_scalar_multiplication_double_and_add(a, b, p, x, y, scalar):
 
     """
 
-    if not is_point_on_curve(a, b, p, x, y):
-        raise Exception("Point must be on curve")
-    elif x is None and y is None:
+    # Validate once here; the intermediate points are on the curve by construction
+    validate_point(a, b, p, x, y)
+    if x is None and y is None:
         return (None, None)
     else:
+        a, b, p, x, y = _to_field(a, b, p, x, y)
         Q = (None, None)
         P = (x, y)
         convert_to_binary_string = str(bin(scalar))[::-1]
 
         for i in range(scalar.num_bits()):
             if convert_to_binary_string[i] == "1":
-                Q = point_add(a, b, p, Q[0], Q[1], P[0], P[1])
-            P = point_double(a, b, p, P[0], P[1])
-        return Q
+                Q = _point_add_unchecked(a, b, p, Q[0], Q[1], P[0], P[1])
+            P = _point_double_unchecked(a, b, p, P[0], P[1])
+        return _from_field(*Q)
 
 def point_scalar_multiplication_montgomerry_ladder(a, b, p, x, y, scalar):
     """
@@ -209,23 +493,640 @@ def point_scalar_multiplication_montgomerry_ladder(a, b, p, x, y, scalar):
         return R0
 
     """
-    if not is_point_on_curve(a, b, p, x, y):
-        raise Exception("Point must be on curve")
-    elif x is None and y is None:
+    # Validate once here; the intermediate points are on the curve by construction
+    validate_point(a, b, p, x, y)
+    if x is None and y is None:
         return (None, None)
     else:
+        a, b, p, x, y = _to_field(a, b, p, x, y)
         R0 = (None, None)
         R1 = (x, y)
         convert_to_binary_string = str(bin(scalar))[::-1]
         for i in reversed(range(0,scalar.num_bits())):
             if convert_to_binary_string[i] == "0":
-                R1 = point_add(a, b, p, R0[0], R0[1], R1[0], R1[1])
-                R0 = point_double(a, b, p, R0[0], R0[1])
+                R1 = _point_add_unchecked(a, b, p, R0[0], R0[1], R1[0], R1[1])
+                R0 = _point_double_unchecked(a, b, p, R0[0], R0[1])
             else:
-                R0 = point_add(a, b, p, R0[0], R0[1], R1[0], R1[1])
-                R1 = point_double(a, b, p, R1[0], R1[1])
-        return R0
+                R0 = _point_add_unchecked(a, b, p, R0[0], R0[1], R1[0], R1[1])
+                R1 = _point_double_unchecked(a, b, p, R1[0], R1[1])
+        return _from_field(*R0)
 
+#####################################################
+# TASK 3 (cont.) -- Jacobian coordinates
+#
+# The affine formulas above need a field inversion for
+# every addition and doubling. In Jacobian coordinates
+# a point (X, Y, Z) stands for the affine point
+# (X / Z^2, Y / Z^3), so additions and doublings only
+# multiply, and a single inversion converts the result
+# of a whole scalar multiplication back to affine.
+#
+# The point at infinity is represented with Z = 0.
+
+def to_jacobian(x, y):
+    """ Lift an affine point (x, y) to Jacobian coordinates (X, Y, Z). """
+    if x is None and y is None:
+        return (1, 1, 0)
+    return (x, y, 1)
+
+def from_jacobian(p, X, Y, Z):
+    """ Convert a Jacobian point back to affine (x, y) using a single inversion.
+
+    Returns (None, None) for the point at infinity.
+    """
+    if Z % p == 0:
+        return (None, None)
+
+    z_inv = field_inverse(Z, p)
+    z_inv2 = (z_inv * z_inv) % p
+    xr = (X * z_inv2) % p
+    yr = (Y * z_inv2 * z_inv) % p
+    return xr, yr
+
+def batch_mod_inverse(p, values):
+    """ Inverts every value modulo p with a single field inversion
+        (Montgomery's simultaneous inversion trick, 3(n-1) multiplications).
+
+        Values that are 0 mod p have no inverse and map to None.
+    """
+    # prefix[i] is the product of the non-zero values before index i
+    prefix = []
+    acc = 1
+    for v in values:
+        prefix.append(acc)
+        if v % p != 0:
+            acc = (acc * v) % p
+
+    inv = field_inverse(acc, p)
+
+    inverses = [None] * len(values)
+    for i in reversed(range(len(values))):
+        v = values[i]
+        if v % p != 0:
+            inverses[i] = (inv * prefix[i]) % p
+            inv = (inv * v) % p
+    return inverses
+
+def batch_from_jacobian(p, points):
+    """ Converts a list of Jacobian points to affine, sharing one inversion. """
+    z_invs = batch_mod_inverse(p, [Z for (_, _, Z) in points])
+
+    affine = []
+    for (X, Y, _), z_inv in zip(points, z_invs):
+        if z_inv is None:
+            affine.append((None, None))
+        else:
+            z_inv2 = (z_inv * z_inv) % p
+            affine.append(((X * z_inv2) % p, (Y * z_inv2 * z_inv) % p))
+    return affine
+
+def jacobian_point_double(a, b, p, X, Y, Z):
+    """ Double a point in Jacobian coordinates, without any inversion.
+
+    Reminder (dbl-2007-bl):
+        S  = 4 * X * Y^2
+        M  = 3 * X^2 + a * Z^4
+        Xr = M^2 - 2 * S
+        Yr = M * (S - Xr) - 8 * Y^4
+        Zr = 2 * Y * Z
+    """
+    if Z % p == 0 or Y % p == 0:
+        return (1, 1, 0)
+
+    XX = (X * X) % p
+    YY = (Y * Y) % p
+    ZZ = (Z * Z) % p
+    S = (4 * X * YY) % p
+    M = (3 * XX + a * ZZ * ZZ) % p
+    Xr = (M * M - 2 * S) % p
+    Yr = (M * (S - Xr) - 8 * YY * YY) % p
+    Zr = (2 * Y * Z) % p
+    return Xr, Yr, Zr
+
+def jacobian_point_add(a, b, p, X1, Y1, Z1, X2, Y2, Z2):
+    """ Add two points in Jacobian coordinates, without any inversion.
+
+    Unlike point_add, equal inputs are handled by falling back to doubling.
+
+    Reminder (add-1998-cmo-2):
+        U1 = X1 * Z2^2,  U2 = X2 * Z1^2
+        S1 = Y1 * Z2^3,  S2 = Y2 * Z1^3
+        H  = U2 - U1,    r  = S2 - S1
+        Xr = r^2 - H^3 - 2 * U1 * H^2
+        Yr = r * (U1 * H^2 - Xr) - S1 * H^3
+        Zr = Z1 * Z2 * H
+    """
+    if Z1 % p == 0:
+        return X2, Y2, Z2
+    if Z2 % p == 0:
+        return X1, Y1, Z1
+
+    Z1Z1 = (Z1 * Z1) % p
+    Z2Z2 = (Z2 * Z2) % p
+    U1 = (X1 * Z2Z2) % p
+    U2 = (X2 * Z1Z1) % p
+    S1 = (Y1 * Z2 * Z2Z2) % p
+    S2 = (Y2 * Z1 * Z1Z1) % p
+    H = (U2 - U1) % p
+    r = (S2 - S1) % p
+
+    if H == 0:
+        if r == 0:
+            return jacobian_point_double(a, b, p, X1, Y1, Z1)
+        return (1, 1, 0)
+
+    HH = (H * H) % p
+    HHH = (H * HH) % p
+    V = (U1 * HH) % p
+    Xr = (r * r - HHH - 2 * V) % p
+    Yr = (r * (V - Xr) - S1 * HHH) % p
+    Zr = (Z1 * Z2 * H) % p
+    return Xr, Yr, Zr
+
+def jacobian_point_mixed_add(a, b, p, X1, Y1, Z1, x2, y2):
+    """ Add an affine point (x2, y2) to a Jacobian point (X1, Y1, Z1).
+
+    Since the second point has Z = 1 this saves several multiplications
+    over jacobian_point_add (madd-2004-hmv).
+    """
+    if x2 is None and y2 is None:
+        return X1, Y1, Z1
+    if Z1 % p == 0:
+        return to_jacobian(x2, y2)
+
+    Z1Z1 = (Z1 * Z1) % p
+    U2 = (x2 * Z1Z1) % p
+    S2 = (y2 * Z1 * Z1Z1) % p
+    H = (U2 - X1) % p
+    r = (S2 - Y1) % p
+
+    if H == 0:
+        if r == 0:
+            return jacobian_point_double(a, b, p, X1, Y1, Z1)
+        return (1, 1, 0)
+
+    HH = (H * H) % p
+    HHH = (H * HH) % p
+    V = (X1 * HH) % p
+    Xr = (r * r - HHH - 2 * V) % p
+    Yr = (r * (V - Xr) - Y1 * HHH) % p
+    Zr = (Z1 * H) % p
+    return Xr, Yr, Zr
+
+def point_scalar_multiplication_double_and_add_jacobian(a, b, p, x, y, scalar):
+    """
+    Same result as point_scalar_multiplication_double_and_add, but the
+    intermediate points are kept in Jacobian coordinates and the bits
+    are scanned from the most significant one, so that every addition
+    is a mixed addition with the affine input point.
+    """
+    validate_point(a, b, p, x, y)
+    if x is None and y is None:
+        return (None, None)
+    else:
+        a, b, p, x, y = _to_field(a, b, p, x, y)
+        Q = to_jacobian(None, None)
+        for i in reversed(range(scalar.num_bits())):
+            Q = jacobian_point_double(a, b, p, Q[0], Q[1], Q[2])
+            if scalar.is_bit_set(i):
+                Q = jacobian_point_mixed_add(a, b, p, Q[0], Q[1], Q[2], x, y)
+        return _from_field(*from_jacobian(p, Q[0], Q[1], Q[2]))
+
+def point_scalar_multiplication_montgomerry_ladder_jacobian(a, b, p, x, y, scalar):
+    """
+    Same result as point_scalar_multiplication_montgomerry_ladder, but the
+    ladder registers R0 and R1 are kept in Jacobian coordinates and only
+    R0 is converted back to affine at the end.
+    """
+    validate_point(a, b, p, x, y)
+    if x is None and y is None:
+        return (None, None)
+    else:
+        a, b, p, x, y = _to_field(a, b, p, x, y)
+        R0 = to_jacobian(None, None)
+        R1 = to_jacobian(x, y)
+        for i in reversed(range(scalar.num_bits())):
+            if not scalar.is_bit_set(i):
+                R1 = jacobian_point_add(a, b, p, R0[0], R0[1], R0[2], R1[0], R1[1], R1[2])
+                R0 = jacobian_point_double(a, b, p, R0[0], R0[1], R0[2])
+            else:
+                R0 = jacobian_point_add(a, b, p, R0[0], R0[1], R0[2], R1[0], R1[1], R1[2])
+                R1 = jacobian_point_double(a, b, p, R1[0], R1[1], R1[2])
+        return _from_field(*from_jacobian(p, R0[0], R0[1], R0[2]))
+
+
+#####################################################
+# TASK 3 (cont.) -- Constant-time Montgomery ladder
+#
+# The ladders above branch on every bit of the secret scalar
+# and point_add takes early exits for infinity and equal
+# points, so their running time depends on the scalar.
+# The ladder below:
+#   - always runs for the same number of iterations,
+#   - swaps R0 and R1 arithmetically instead of branching,
+#   - uses the complete projective formulas of Renes,
+#     Costello and Batina (2016), which have no special
+#     cases for infinity or equal points.
+#
+# Projective (X : Y : Z) stands for the affine (X / Z, Y / Z),
+# and the point at infinity is (0 : 1 : 0).
+
+def _projective_complete_add(a, b3, p, X1, Y1, Z1, X2, Y2, Z2):
+    """ Complete addition for any a (RCB16, Algorithm 1), with b3 = 3 * b. """
+    t0 = (X1 * X2) % p
+    t1 = (Y1 * Y2) % p
+    t2 = (Z1 * Z2) % p
+    t3 = ((X1 + Y1) * (X2 + Y2) - t0 - t1) % p
+    t4 = ((X1 + Z1) * (X2 + Z2) - t0 - t2) % p
+    t5 = ((Y1 + Z1) * (Y2 + Z2) - t1 - t2) % p
+    Z3 = (a * t4 + b3 * t2) % p
+    X3 = (t1 - Z3) % p
+    Z3 = (t1 + Z3) % p
+    Y3 = (X3 * Z3) % p
+    t1 = (3 * t0 + a * t2) % p
+    t2 = (a * (t0 - a * t2)) % p
+    t4 = (b3 * t4 + t2) % p
+    Y3 = (Y3 + t1 * t4) % p
+    X3 = (t3 * X3 - t5 * t4) % p
+    Z3 = (t5 * Z3 + t3 * t1) % p
+    return X3, Y3, Z3
+
+def _projective_complete_double(a, b3, p, X, Y, Z):
+    """ Complete doubling for any a (RCB16, Algorithm 3), with b3 = 3 * b. """
+    t0 = (X * X) % p
+    t1 = (Y * Y) % p
+    t2 = (Z * Z) % p
+    t3 = (2 * X * Y) % p
+    Z3 = (2 * X * Z) % p
+    X3 = (a * Z3) % p
+    Y3 = (b3 * t2 + X3) % p
+    X3 = (t1 - Y3) % p
+    Y3 = (X3 * (t1 + Y3)) % p
+    X3 = (t3 * X3) % p
+    Z3 = (b3 * Z3) % p
+    t2 = (a * t2) % p
+    t3 = (a * (t0 - t2) + Z3) % p
+    t0 = (3 * t0 + t2) % p
+    Y3 = (Y3 + t0 * t3) % p
+    t2 = (2 * Y * Z) % p
+    X3 = (X3 - t2 * t3) % p
+    Z3 = (4 * t2 * t1) % p
+    return X3, Y3, Z3
+
+def _projective_cswap(bit, P, Q):
+    """ Returns (Q, P) if bit is 1 and (P, Q) if it is 0, without branching on bit. """
+    Pr, Qr = [], []
+    for u, v in zip(P, Q):
+        d = (u - v) * bit
+        Pr.append(u - d)
+        Qr.append(v + d)
+    return tuple(Pr), tuple(Qr)
+
+def point_scalar_multiplication_montgomerry_ladder_ct(a, b, p, x, y, scalar, num_bits=None):
+    """
+    Montgomery ladder whose sequence of operations does not depend on the scalar.
+
+    The scalar is processed as a num_bits long string, padded with leading
+    zeros (by default p.num_bits() + 1 bits, enough for any scalar smaller
+    than the group order). Every iteration does one conditional swap, one
+    complete addition and one complete doubling.
+    """
+    validate_point(a, b, p, x, y)
+    if num_bits is None:
+        num_bits = p.num_bits() + 1
+    if scalar.num_bits() > num_bits:
+        raise Exception("Scalar too large for the ladder")
+
+    a, b, p, x, y = _to_field(a, b, p, x, y)
+    b3 = (3 * b) % p
+    R0 = (0, 1, 0)
+    if x is None and y is None:
+        R1 = (0, 1, 0)
+    else:
+        R1 = (x, y, 1)
+
+    swap = 0
+    for i in reversed(range(num_bits)):
+        bit = scalar.is_bit_set(i)
+        R0, R1 = _projective_cswap(swap ^ bit, R0, R1)
+        swap = bit
+        R1 = _projective_complete_add(a, b3, p, R0[0], R0[1], R0[2], R1[0], R1[1], R1[2])
+        R0 = _projective_complete_double(a, b3, p, R0[0], R0[1], R0[2])
+    R0, R1 = _projective_cswap(swap, R0, R1)
+
+    X, Y, Z = R0
+    if Z == 0:
+        return (None, None)
+    z_inv = field_inverse_fermat(Z, p)
+    return _from_field((X * z_inv) % p, (Y * z_inv) % p)
+
+#####################################################
+# TASK 3 (cont.) -- Complete projective model
+#
+# A second model of the same curves, alongside the affine and
+# Jacobian functions: homogeneous projective coordinates with
+# the complete formulas used by the constant-time ladder.
+# A single addition formula covers every pair of inputs,
+# including P + P, P + (-P) and the point at infinity, so
+# callers never special-case or route through doubling.
+#
+# (Twisted Edwards forms need a point of order 4, which the
+# prime-order NIST curves do not have, hence complete
+# short-Weierstrass formulas rather than an Edwards model.)
+
+def to_projective(x, y):
+    """ Lift an affine point (x, y) to projective coordinates (X : Y : Z). """
+    if x is None and y is None:
+        return (0, 1, 0)
+    return (x, y, 1)
+
+def from_projective(p, X, Y, Z):
+    """ Convert a projective point back to affine (X / Z, Y / Z).
+
+    Returns (None, None) for the point at infinity.
+    """
+    if Z % p == 0:
+        return (None, None)
+    z_inv = field_inverse(Z, p)
+    return (X * z_inv) % p, (Y * z_inv) % p
+
+def jacobian_to_projective(p, X, Y, Z):
+    """ (X, Y, Z) Jacobian is (X * Z : Y : Z^3) projective. """
+    if Z % p == 0:
+        return (0, 1, 0)
+    return (X * Z) % p, Y % p, (Z * Z * Z) % p
+
+def projective_to_jacobian(p, X, Y, Z):
+    """ (X : Y : Z) projective is (X * Z, Y * Z^2, Z) Jacobian. """
+    if Z % p == 0:
+        return (1, 1, 0)
+    return (X * Z) % p, (Y * Z * Z) % p, Z % p
+
+def complete_point_add(a, b, p, X1, Y1, Z1, X2, Y2, Z2):
+    """ Adds any two projective points, equal, opposite or infinite included. """
+    return _projective_complete_add(a, (3 * b) % p, p, X1, Y1, Z1, X2, Y2, Z2)
+
+def complete_point_double(a, b, p, X, Y, Z):
+    """ Doubles any projective point (cheaper than complete_point_add of P and P). """
+    return _projective_complete_double(a, (3 * b) % p, p, X, Y, Z)
+
+def point_scalar_multiplication_complete(a, b, p, x, y, scalar, num_bits=None):
+    """
+    Double-and-add-always with the complete formulas:
+
+        Q = infinity
+        for each of num_bits bits, most significant first:
+            Q = 2 * Q
+            T = Q + P
+            Q = T if the bit is set, else Q  (arithmetic select)
+        return Q
+
+    Like the constant-time ladder it runs a fixed number of iterations,
+    p.num_bits() + 1 by default, with no branch on the bits of the scalar.
+    """
+    validate_point(a, b, p, x, y)
+    if num_bits is None:
+        num_bits = p.num_bits() + 1
+    if scalar.num_bits() > num_bits:
+        raise Exception("Scalar too large for the fixed length")
+
+    a, b, p, x, y = _to_field(a, b, p, x, y)
+    b3 = (3 * b) % p
+    P = to_projective(x, y)
+    Q = (0, 1, 0)
+    for i in reversed(range(num_bits)):
+        Q = _projective_complete_double(a, b3, p, Q[0], Q[1], Q[2])
+        T = _projective_complete_add(a, b3, p, Q[0], Q[1], Q[2], P[0], P[1], P[2])
+        _, Q = _projective_cswap(scalar.is_bit_set(i), T, Q)
+    return _from_field(*from_projective(p, Q[0], Q[1], Q[2]))
+
+#####################################################
+# TASK 3 (cont.) -- Width-w NAF scalar multiplication
+#
+# Recoding the scalar into width-w non-adjacent form gives
+# odd digits |d| < 2^(w-1), with at most one non-zero digit
+# in any w consecutive positions. With a small table of the
+# odd multiples P, 3P, ..., (2^(w-1) - 1)P only about
+# num_bits / (w + 1) additions are needed, instead of about
+# num_bits / 2 for plain double-and-add.
+
+def wnaf_recode(scalar, w):
+    """ Returns the width-w NAF digits of a non-negative Bn scalar,
+        least significant first, so that scalar = sum(d_i * 2^i).
+
+        Only reads the bits of the scalar, without converting it to a string.
+    """
+    assert isinstance(scalar, Bn) and scalar >= 0
+    assert w >= 2
+
+    half = 2**(w - 1)
+    full = 2**w
+
+    # 'window' holds bits j .. j+w-1 of what remains to be recoded
+    window = 0
+    for i in range(w):
+        window += scalar.is_bit_set(i) << i
+
+    digits = []
+    j = 0
+    num_bits = scalar.num_bits()
+    while j < num_bits or window != 0:
+        if window & 1:
+            d = window if window < half else window - full
+            window -= d
+        else:
+            d = 0
+        digits.append(d)
+
+        window >>= 1
+        window += scalar.is_bit_set(j + w) << (w - 1)
+        j += 1
+
+    return digits
+
+def _odd_multiples(a, b, p, x, y, w):
+    """ Returns [P, 3P, ..., (2^(w-1) - 1)P] in Jacobian coordinates.
+        Use batch_from_jacobian to turn one or more of these tables into
+        affine points, so that the main loop can use mixed additions. """
+    P = to_jacobian(x, y)
+    P2 = jacobian_point_double(a, b, p, P[0], P[1], P[2])
+    multiples = [P]
+    for _ in range(2**(w - 2) - 1):
+        Pi = multiples[-1]
+        multiples.append(jacobian_point_add(a, b, p, Pi[0], Pi[1], Pi[2], P2[0], P2[1], P2[2]))
+    return multiples
+
+def point_scalar_multiplication_wnaf(a, b, p, x, y, scalar, w=4):
+    """
+    Point multiplication with a scalar using its width-w NAF:
+
+        precompute P, 3P, ..., (2^(w-1) - 1)P
+        Q = infinity
+        for each digit d, most significant first:
+            Q = 2 * Q
+            if d > 0 then Q = Q + dP
+            if d < 0 then Q = Q - |d|P
+        return Q
+
+    Intermediate points are kept in Jacobian coordinates.
+    """
+    validate_point(a, b, p, x, y)
+    if x is None and y is None:
+        return (None, None)
+
+    a, b, p, x, y = _to_field(a, b, p, x, y)
+    table = batch_from_jacobian(p, _odd_multiples(a, b, p, x, y, w))
+    Q = _wnaf_jacobian(a, b, p, table, wnaf_recode(scalar, w))
+    return _from_field(*from_jacobian(p, Q[0], Q[1], Q[2]))
+
+def _wnaf_jacobian(a, b, p, table, digits):
+    """ The wNAF main loop, with an affine table of odd multiples.
+        Returns a Jacobian point. """
+    Q = to_jacobian(None, None)
+    for d in reversed(digits):
+        Q = jacobian_point_double(a, b, p, Q[0], Q[1], Q[2])
+        if d > 0:
+            x, y = table[d // 2]
+            Q = jacobian_point_mixed_add(a, b, p, Q[0], Q[1], Q[2], x, y)
+        elif d < 0:
+            x, y = table[(-d) // 2]
+            Q = jacobian_point_mixed_add(a, b, p, Q[0], Q[1], Q[2], x, (p - y) % p)
+    return Q
+
+def batch_point_scalar_multiplication(a, b, p, points, scalars, w=4):
+    """
+    Computes [k_1 * P_1, ..., k_n * P_n] for affine points and Bn scalars.
+
+    Works like point_scalar_multiplication_wnaf, but the odd-multiple tables
+    of all points are normalised together, and so are the results:
+    two field inversions in total instead of two per point.
+    """
+    if len(points) != len(scalars):
+        raise Exception("Need as many scalars as points")
+
+    for (x, y) in points:
+        validate_point(a, b, p, x, y)
+
+    a, b, p = _to_field(a, b, p)
+    points = [_to_field(x, y) for (x, y) in points]
+    size = 2**(w - 2)
+    jacobian_tables = []
+    for (x, y) in points:
+        if x is None and y is None:
+            jacobian_tables += [to_jacobian(None, None)] * size
+        else:
+            jacobian_tables += _odd_multiples(a, b, p, x, y, w)
+    affine_tables = batch_from_jacobian(p, jacobian_tables)
+
+    results = []
+    for i, ((x, y), k) in enumerate(zip(points, scalars)):
+        if x is None and y is None:
+            results.append(to_jacobian(None, None))
+        else:
+            table = affine_tables[i * size:(i + 1) * size]
+            results.append(_wnaf_jacobian(a, b, p, table, wnaf_recode(k, w)))
+    return [_from_field(x, y) for (x, y) in batch_from_jacobian(p, results)]
+
+#####################################################
+# TASK 3 (cont.) -- Multi-scalar multiplication
+#
+# Computes k_1 * P_1 + ... + k_n * P_n with the doublings
+# shared between all the terms, instead of n independent
+# scalar multiplications followed by n - 1 additions.
+#   - Straus: interleave the wNAF digits of all scalars
+#     (a small odd-multiples table per point).
+#   - Pippenger: for each c-bit window, drop every point
+#     in the bucket of its digit, then combine the buckets
+#     with two running sums.
+
+STRAUS_WINDOW = 4
+PIPPENGER_THRESHOLD = 500
+
+def _multi_scalar_straus(a, b, p, points, scalars, w=STRAUS_WINDOW):
+    size = 2**(w - 2)
+    jacobian_tables = []
+    for (x, y) in points:
+        jacobian_tables += _odd_multiples(a, b, p, x, y, w)
+    affine_tables = batch_from_jacobian(p, jacobian_tables)
+    tables = [affine_tables[i:i + size] for i in range(0, len(affine_tables), size)]
+    all_digits = [wnaf_recode(k, w) for k in scalars]
+
+    Q = to_jacobian(None, None)
+    for i in reversed(range(max(len(digits) for digits in all_digits))):
+        Q = jacobian_point_double(a, b, p, Q[0], Q[1], Q[2])
+        for table, digits in zip(tables, all_digits):
+            d = digits[i] if i < len(digits) else 0
+            if d > 0:
+                x, y = table[d // 2]
+                Q = jacobian_point_mixed_add(a, b, p, Q[0], Q[1], Q[2], x, y)
+            elif d < 0:
+                x, y = table[(-d) // 2]
+                Q = jacobian_point_mixed_add(a, b, p, Q[0], Q[1], Q[2], x, (p - y) % p)
+    return Q
+
+def _multi_scalar_pippenger(a, b, p, points, scalars, c=None):
+    if c is None:
+        c = max(2, len(points).bit_length() - 4)
+
+    ks = [int(k) for k in scalars]
+    num_windows = (max(k.bit_length() for k in ks) + c - 1) // c
+    mask = 2**c - 1
+
+    Q = to_jacobian(None, None)
+    for window in reversed(range(num_windows)):
+        for _ in range(c):
+            Q = jacobian_point_double(a, b, p, Q[0], Q[1], Q[2])
+
+        # Bucket j collects every point whose digit in this window is j
+        buckets = [to_jacobian(None, None) for _ in range(mask + 1)]
+        shift = window * c
+        for (x, y), k in zip(points, ks):
+            digit = (k >> shift) & mask
+            if digit:
+                B = buckets[digit]
+                buckets[digit] = jacobian_point_mixed_add(a, b, p, B[0], B[1], B[2], x, y)
+
+        # sum_j j * B_j, as the sum of the running sums B_top + ... + B_j
+        # (buckets normalised together, so the running sum uses mixed additions)
+        running = to_jacobian(None, None)
+        total = to_jacobian(None, None)
+        for (x, y) in reversed(batch_from_jacobian(p, buckets[1:])):
+            running = jacobian_point_mixed_add(a, b, p, running[0], running[1], running[2], x, y)
+            total = jacobian_point_add(a, b, p, total[0], total[1], total[2],
+                                       running[0], running[1], running[2])
+
+        Q = jacobian_point_add(a, b, p, Q[0], Q[1], Q[2], total[0], total[1], total[2])
+    return Q
+
+def multi_scalar_multiplication(a, b, p, points, scalars):
+    """
+    Computes the sum of scalars[i] * points[i], where points is a list of
+    affine (x, y) tuples and scalars a list of non-negative Bn.
+
+    Uses Straus interleaving for few terms and Pippenger buckets when there
+    are more than PIPPENGER_THRESHOLD terms. Returns an affine point.
+    """
+    if len(points) != len(scalars):
+        raise Exception("Need as many scalars as points")
+
+    # Validate every point once; terms that contribute nothing are dropped
+    terms = []
+    for (x, y), k in zip(points, scalars):
+        validate_point(a, b, p, x, y)
+        if not (x is None and y is None) and k != 0:
+            terms.append(((x, y), k))
+
+    if not terms:
+        return (None, None)
+
+    a, b, p = _to_field(a, b, p)
+    points = [_to_field(x, y) for ((x, y), _) in terms]
+    scalars = [k for (_, k) in terms]
+    if len(terms) > PIPPENGER_THRESHOLD:
+        Q = _multi_scalar_pippenger(a, b, p, points, scalars)
+    else:
+        Q = _multi_scalar_straus(a, b, p, points, scalars)
+    return _from_field(*from_jacobian(p, Q[0], Q[1], Q[2]))
 
 #####################################################
 # TASK 4 -- Standard ECDSA signatures
@@ -236,25 +1137,136 @@ def point_scalar_multiplication_montgomerry_ladder(a, b, p, x, y, scalar):
 #            using petlib.ecdsa
 
 from hashlib import sha256
-from petlib.ec import EcGroup
+from timeit import default_timer as timer
+from petlib.ec import EcGroup, EcPt, POINT_CONVERSION_UNCOMPRESSED
 from petlib.ecdsa import do_ecdsa_sign, do_ecdsa_verify
 
+## Group caching.
+#  EcGroup() precomputes its own multiplication tables for the generator
+#  every time it is constructed, so key generation shares one group per
+#  curve. OpenSSL's generator multiplication is used as it is: it is
+#  both faster and constant-time, unlike a Python table of multiples.
+
+_GROUP_CACHE = {}
+
+def get_group(nid=713):
+    """ Returns an EcGroup for the curve nid, shared by the whole process. """
+    if nid not in _GROUP_CACHE:
+        _GROUP_CACHE[nid] = EcGroup(nid)
+    return _GROUP_CACHE[nid]
+
+## Precomputed ephemeral values.
+#  Both ECDSA signing and dh_encrypt start by drawing a random scalar k
+#  and computing k * g, none of which depends on the message. A pool
+#  computes those in a background thread ahead of time, so that the
+#  online path only pays for the work that needs the message or the
+#  peer's key. Each precomputed value is handed out once: reusing an
+#  ECDSA nonce leaks the signing key.
+
+import threading
+from collections import deque, OrderedDict
+from petlib.ecdsa import do_ecdsa_setup
+
+PRECOMPUTE_LOW_WATERMARK = 16
+PRECOMPUTE_HIGH_WATERMARK = 64
+
+class PrecomputePool(object):
+    """ A pool of values computed by factory() in a background thread.
+
+    Whenever the pool holds low or fewer values the thread refills it
+    up to high values. If the pool runs dry, take() computes a value
+    inline rather than waiting for the thread.
+    """
+
+    def __init__(self, factory, low=PRECOMPUTE_LOW_WATERMARK,
+                 high=PRECOMPUTE_HIGH_WATERMARK):
+        if not 0 <= low < high:
+            raise Exception("Watermarks must satisfy 0 <= low < high")
+        self.factory = factory
+        self.low = low
+        self.high = high
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _fill(self):
+        while True:
+            with self._cond:
+                while not self._stopped and len(self._items) > self.low:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+            full = False
+            while not full:
+                item = self.factory()
+                with self._cond:
+                    if self._stopped:
+                        return
+                    self._items.append(item)
+                    full = len(self._items) >= self.high
+                    self._cond.notify_all()
+
+    def take(self):
+        """ Returns a value that has not been handed out before. """
+        with self._cond:
+            if self._items:
+                item = self._items.popleft()
+                if len(self._items) <= self.low:
+                    self._cond.notify_all()
+                return item
+        return self.factory()
+
+    def wait_full(self, timeout=None):
+        """ Blocks until the pool holds high values (or the timeout expires). """
+        with self._cond:
+            start = timer()
+            while not self._stopped and len(self._items) < self.high:
+                remaining = None if timeout is None else timeout - (timer() - start)
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return len(self._items) >= self.high
+
+    def stop(self):
+        """ Stops the background thread and discards the unused values. """
+        with self._cond:
+            self._stopped = True
+            self._items.clear()
+            self._cond.notify_all()
+        self._thread.join()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._items)
+
+def ecdsa_sign_pool(G, priv_sign, low=PRECOMPUTE_LOW_WATERMARK,
+                    high=PRECOMPUTE_HIGH_WATERMARK):
+    """ Returns a pool of ECDSA (k^-1, r) setups for ecdsa_sign. """
+    return PrecomputePool(lambda: do_ecdsa_setup(G, priv_sign), low, high)
+
 def ecdsa_key_gen():
     """ Returns an EC group, a random private key for signing 
         and the corresponding public key for verification"""
-    G = EcGroup()
+    G = get_group()
     priv_sign = G.order().random()
     pub_verify = priv_sign * G.generator()
     return (G, priv_sign, pub_verify)
 
 
-def ecdsa_sign(G, priv_sign, message):
-    """ Sign the SHA256 digest of the message using ECDSA and return a signature """
+def ecdsa_sign(G, priv_sign, message, pool=None):
+    """ Sign the SHA256 digest of the message using ECDSA and return a signature.
+        Optionally take the nonce setup from a pool made by ecdsa_sign_pool. """
     plaintext =  message.encode("utf8")
 
     ## YOUR CODE HERE
     digest = sha256(plaintext).digest()
-    sig = do_ecdsa_sign(G, priv_sign, digest)
+    kinv_rp = None if pool is None else pool.take()
+    sig = do_ecdsa_sign(G, priv_sign, digest, kinv_rp)
     return sig
 
 def ecdsa_verify(G, pub_verify, message, sig):
@@ -266,6 +1278,108 @@ def ecdsa_verify(G, pub_verify, message, sig):
     res = do_ecdsa_verify(G, pub_verify, sig, digest)
     return res
 
+## Batch verification.
+#  A randomised combined check (sum of a_i * (u1_i * g + u2_i * Q_i - R_i))
+#  does not work for plain ECDSA: a signature only carries the x-coordinate
+#  r of R_i, and the missing signs of the y-coordinates would have to be
+#  guessed for the whole batch. Instead, batch verification hashes all
+#  messages up front, groups signatures by public key, so that each key is
+#  decoded once, and optionally spreads the groups over a process pool.
+#  petlib objects cannot be pickled, so keys and signatures cross process
+#  boundaries in their binary encodings.
+
+import multiprocessing
+
+BATCH_CHUNK_SIZE = 256
+
+def _chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def _ecdsa_verify_checks(G, pub, checks):
+    results = []
+    for digest, sig in checks:
+        try:
+            results.append(do_ecdsa_verify(G, pub, sig, digest))
+        except Exception:
+            results.append(False)
+    return results
+
+def _ecdsa_verify_job(job):
+    nid, pub_bin, checks = job
+    G = get_group(nid)
+    return _ecdsa_verify_checks(G, EcPt.from_binary(pub_bin, G),
+        [(digest, (Bn.from_binary(r), Bn.from_binary(s))) for digest, r, s in checks])
+
+def _encode_signature(digest, sig):
+    try:
+        r, s = sig
+        return (digest, r.binary(), s.binary())
+    except Exception:
+        return None
+
+def ecdsa_verify_batch(G, items, processes=None, chunk_size=BATCH_CHUNK_SIZE):
+    """ Verify a list of (pub_verify, message, sig) triples, returning a
+        list with one boolean per item. With processes > 1 the work is
+        spread over a pool of that many worker processes. """
+    # Malformed items are left as failures rather than aborting the batch
+    groups = OrderedDict()
+    for index, item in enumerate(items):
+        try:
+            pub, message, sig = item
+            digest = sha256(message.encode("utf8")).digest()
+            groups.setdefault(pub.export(), (pub, []))[1].append((index, digest, sig))
+        except Exception:
+            pass
+
+    positions, outcomes = [], []
+    if processes is not None and processes > 1:
+        jobs = []
+        for pub_bin, (pub, group) in groups.items():
+            encoded = [(index, _encode_signature(digest, sig)) for index, digest, sig in group]
+            encoded = [(index, check) for index, check in encoded if check is not None]
+            for chunk in _chunks(encoded, chunk_size):
+                positions.append([index for index, _ in chunk])
+                jobs.append((G.nid(), pub_bin, [check for _, check in chunk]))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            outcomes = pool.map(_ecdsa_verify_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for pub, group in groups.values():
+            positions.append([index for index, _, _ in group])
+            outcomes.append(_ecdsa_verify_checks(G, pub, [(digest, sig) for _, digest, sig in group]))
+
+    results = [False] * len(items)
+    for indexes, outcome in zip(positions, outcomes):
+        for index, valid in zip(indexes, outcome):
+            results[index] = valid
+    return results
+
+def time_ecdsa_verify_batch(count=2000, keys=4, processes=(1, 2, 4)):
+    """ Compares signatures/sec verified one at a time with ecdsa_verify
+        against ecdsa_verify_batch with different numbers of processes. """
+    signers = [ecdsa_key_gen() for _ in range(keys)]
+    items = []
+    for i in range(count):
+        G, priv, pub = signers[i % keys]
+        message = u"Message %d" % i
+        items.append((pub, message, ecdsa_sign(G, priv, message)))
+
+    start = timer()
+    for pub, message, sig in items:
+        ecdsa_verify(G, pub, message, sig)
+    results = {"serial": count / (timer() - start)}
+
+    for n in processes:
+        start = timer()
+        ecdsa_verify_batch(G, items, processes=n)
+        results["batch_%d_processes" % n] = count / (timer() - start)
+    return results
+
 #####################################################
 # TASK 5 -- Diffie-Hellman Key Exchange and Derivation
 #           - use Bob's public key to derive a shared key.
@@ -276,23 +1390,89 @@ def ecdsa_verify(G, pub_verify, message, sig):
 
 def dh_get_key():
     """ Generate a DH key pair """
-    G = EcGroup()
+    G = get_group()
     priv_dec = G.order().random()
     pub_enc = priv_dec * G.generator()
     return (G, priv_dec, pub_enc)
 
-
-def dh_encrypt(pub, message, aliceSig = None):
+def _dh_key_pair(G):
+    priv = G.order().random()
+    return (priv, priv * G.generator())
+
+def dh_key_pool(low=PRECOMPUTE_LOW_WATERMARK, high=PRECOMPUTE_HIGH_WATERMARK):
+    """ Returns a pool of (priv, pub) ephemeral key pairs for dh_encrypt. """
+    G = get_group()
+    return PrecomputePool(lambda: _dh_key_pair(G), low, high)
+
+def time_key_generation(repetitions=1000):
+    """ Compares keys/sec of the original key generation (a fresh EcGroup()
+        and priv * G.generator() per key) with dh_get_key, which uses the
+        cached group. """
+    start = timer()
+    for _ in range(repetitions):
+        G = EcGroup()
+        priv = G.order().random()
+        pub = priv * G.generator()
+    before = repetitions / (timer() - start)
+
+    start = timer()
+    for _ in range(repetitions):
+        dh_get_key()
+    after = repetitions / (timer() - start)
+
+    return {"keys_per_second_before": before,
+            "keys_per_second_after": after}
+
+def time_precomputation(repetitions=200):
+    """ Compares messages/sec of dh_encrypt and ecdsa_sign with and without
+        a full precomputation pool. """
+    G, priv, pub = dh_get_key()
+    message = u"Hello World"
+    results = {}
+
+    dh_pool = dh_key_pool(high=repetitions + 1)
+    sign_pool = ecdsa_sign_pool(G, priv, high=repetitions + 1)
+    try:
+        dh_pool.wait_full()
+        sign_pool.wait_full()
+
+        for name, run, pool in [
+                ("dh_encrypt", lambda p: dh_encrypt(pub, message, pool=p), dh_pool),
+                ("ecdsa_sign", lambda p: ecdsa_sign(G, priv, message, pool=p), sign_pool)]:
+            start = timer()
+            for _ in range(repetitions):
+                run(None)
+            before = repetitions / (timer() - start)
+
+            start = timer()
+            for _ in range(repetitions):
+                run(pool)
+            after = repetitions / (timer() - start)
+
+            results[name] = {"per_second_without_pool": before,
+                             "per_second_with_pool": after}
+    finally:
+        dh_pool.stop()
+        sign_pool.stop()
+
+    return results
+
+
+def dh_encrypt(pub, message, aliceSig = None, pool = None):
     """ Assume you know the public key of someone else (Bob), 
     and wish to Encrypt a message for them.
         - Generate a fresh DH key for this message.
+          (or take a precomputed one from a pool made by dh_key_pool).
         - Derive a fresh shared key.
         - Use the shared key to AES_GCM encrypt the message.
         - Optionally: sign the message with Alice's key.
     """
-    G,  priv_a, pub_a = dh_get_key()
+    if pool is None:
+        G,  priv_a, pub_a = dh_get_key()
+    else:
+        priv_a, pub_a = pool.take()
 
-    shared_key = sha256((priv_a * pub).export()).digest()[:16] #(pub)^priv_a mod p
+    shared_key = dh_shared_key(priv_a, pub) #(pub)^priv_a mod p
     iv, ciphertext, tag = encrypt_message(shared_key, message)
 
     cipher_elements = (iv, ciphertext, tag, pub_a)
@@ -307,11 +1487,253 @@ def dh_decrypt(priv, ciphertext, aliceVer = None):
     
     ## to decrypt we require iv, ciphertext, tag which can be passed into ciphpertext
     iv, ciphertext, tag, pub_a = ciphertext[0], ciphertext[1], ciphertext[2], ciphertext[3]
-    shared_key = sha256((priv * pub_a).export()).digest()[:16] #(pub)^priv_a mod p
+    shared_key = dh_shared_key(priv, pub_a) #(pub)^priv_a mod p
     decrypted_message = decrypt_message(shared_key, iv, ciphertext, tag)
 
     return decrypted_message
 
+## Multi-recipient encryption.
+#  The message body is encrypted once, under a random content key, and
+#  only the 16 byte content key is wrapped for each recipient, using the
+#  key shared between the single ephemeral key and that recipient. Each
+#  wrapping key is used exactly once, so a fixed nonce is safe for it.
+#  The wrapped keys carry no recipient identifiers: a recipient performs
+#  one ECDH and then tries each (cheap) unwrapping in turn.
+
+WRAP_IV = b"\x00" * 12
+
+def dh_shared_key(priv, pub):
+    """ Derive the 16 byte AES key shared by the holders of priv and pub. """
+    return sha256((priv * pub).export()).digest()[:16]
+
+def dh_encrypt_multi(pubs, message, pool = None):
+    """ Encrypt a message once for all of the public keys in pubs. Returns
+        (iv, ciphertext, tag, pub_a, wrapped_keys), where wrapped_keys holds
+        one (wrapped_key, wrap_tag) pair per recipient, in the order of pubs. """
+    if pool is None:
+        G, priv_a, pub_a = dh_get_key()
+    else:
+        priv_a, pub_a = pool.take()
+
+    content_key = urandom(16)
+    iv, ciphertext, tag = encrypt_message(content_key, message)
+
+    aes = Cipher("aes-128-gcm")
+    wrapped_keys = [aes.quick_gcm_enc(dh_shared_key(priv_a, pub), WRAP_IV, content_key)
+                    for pub in pubs]
+
+    return (iv, ciphertext, tag, pub_a, wrapped_keys)
+
+def dh_decrypt_multi(priv, ciphertext):
+    """ Decrypt a message produced by dh_encrypt_multi using one of the
+        recipients' private keys. Throws an exception if priv is not a
+        recipient or the message was modified. """
+    iv, ciphertext, tag, pub_a, wrapped_keys = ciphertext
+    shared_key = dh_shared_key(priv, pub_a)
+
+    aes = Cipher("aes-128-gcm")
+    for wrapped_key, wrap_tag in wrapped_keys:
+        try:
+            content_key = aes.quick_gcm_dec(shared_key, WRAP_IV, wrapped_key, wrap_tag)
+        except Exception:
+            continue
+        plain = aes.quick_gcm_dec(content_key, iv, ciphertext, tag)
+        return plain.decode("utf8")
+
+    raise Exception("Not a recipient of this message")
+
+def time_multi_recipient(sizes=(1, 10, 100), message_size=64*1024):
+    """ Compares the seconds taken to send one message to N recipients with
+        N calls to dh_encrypt against one call to dh_encrypt_multi. """
+    message = u"x" * message_size
+    results = []
+    for n in sizes:
+        pubs = [dh_get_key()[2] for _ in range(n)]
+
+        start = timer()
+        for pub in pubs:
+            dh_encrypt(pub, message)
+        separate = timer() - start
+
+        start = timer()
+        dh_encrypt_multi(pubs, message)
+        multi = timer() - start
+
+        results.append({"recipients": n,
+                        "separate_seconds": separate,
+                        "multi_seconds": multi})
+    return results
+
+## Parallel decryption.
+#  Decryption is CPU bound, so large numbers of ciphertexts are split into
+#  chunks that are decrypted by a pool of worker processes. Each chunk is
+#  sent as binary encodings (petlib objects cannot be pickled), results
+#  come back in input order, and a ciphertext that fails to decrypt is
+#  reported in its own result instead of aborting the batch.
+
+DecryptResult = namedtuple('DecryptResult', ['message', 'error'])
+
+def _dh_decrypt_one(priv, ciphertext):
+    try:
+        iv, ciphertext, tag, pub_a = ciphertext
+        aes = Cipher("aes-128-gcm")
+        plain = aes.quick_gcm_dec(dh_shared_key(priv, pub_a), iv, ciphertext, tag)
+        return DecryptResult(plain.decode("utf8"), None)
+    except Exception as e:
+        return DecryptResult(None, str(e))
+
+def _encode_ciphertext(ciphertext):
+    # Uncompressed points are much cheaper to decode in the workers
+    try:
+        iv, ciphertext, tag, pub_a = ciphertext
+        return (iv, ciphertext, tag, pub_a.export(POINT_CONVERSION_UNCOMPRESSED))
+    except Exception as e:
+        return str(e)
+
+def _dh_decrypt_job(job):
+    nid, priv_bin, chunk = job
+    G = get_group(nid)
+    priv = Bn.from_binary(priv_bin)
+    results = []
+    for encoded in chunk:
+        if isinstance(encoded, tuple):
+            iv, ciphertext, tag, pub_a = encoded
+            results.append(_dh_decrypt_one(priv, (iv, ciphertext, tag, EcPt.from_binary(pub_a, G))))
+        else:
+            results.append(DecryptResult(None, encoded))
+    return results
+
+def dh_decrypt_parallel(priv, ciphertexts, processes=None, chunk_size=BATCH_CHUNK_SIZE):
+    """ Decrypt (iv, ciphertext, tag, pub_a) tuples with a pool of processes
+        (default: one per core). Returns a DecryptResult per ciphertext, in
+        input order, holding either the message or the error. """
+    ciphertexts = list(ciphertexts)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1:
+        return [_dh_decrypt_one(priv, c) for c in ciphertexts]
+
+    nid = get_group().nid()
+    jobs = ((nid, priv.binary(), [_encode_ciphertext(c) for c in chunk])
+            for chunk in _chunks(ciphertexts, chunk_size))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = []
+        for chunk_results in pool.imap(_dh_decrypt_job, jobs):
+            results.extend(chunk_results)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def time_parallel_decrypt(count=4000, max_processes=None):
+    """ Reports ciphertexts/sec decrypted by dh_decrypt_parallel with
+        1 up to max_processes (default: the number of cores) processes. """
+    if max_processes is None:
+        max_processes = multiprocessing.cpu_count()
+    G, priv, pub = dh_get_key()
+    pool = dh_key_pool()
+    try:
+        ciphertexts = [dh_encrypt(pub, u"Message %d" % i, pool=pool) for i in range(count)]
+    finally:
+        pool.stop()
+
+    results = []
+    for n in range(1, max_processes + 1):
+        start = timer()
+        dh_decrypt_parallel(priv, ciphertexts, processes=n)
+        results.append({"processes": n, "per_second": count / (timer() - start)})
+    return results
+
+## Session mode between long-lived peers.
+#  When the same peers exchange many messages, the ECDH can be done once
+#  per peer: a SessionKeys object keeps the master secret shared with
+#  each recent peer in a bounded LRU cache, keyed by the peer's encoded
+#  public key. Every message then gets its own key,
+#  sha256(master | sender pub | recipient pub | iv)[:16], so that
+#  steady-state decryption is purely symmetric work. Both public keys go
+#  into the key, so a message cannot be reflected back to its sender. Messages keep the (iv, ciphertext, tag, pub) format
+#  of dh_encrypt, with pub the sender's long-lived public key.
+
+SESSION_CACHE_SIZE = 1024
+
+class SessionKeys(object):
+    """ Session encryption under a long-lived key pair (priv, pub),
+        caching the secrets shared with up to max_peers peers. """
+
+    def __init__(self, priv, max_peers=SESSION_CACHE_SIZE):
+        if max_peers < 1:
+            raise Exception("The session cache must hold at least one peer")
+        self.priv = priv
+        self.pub = priv * get_group().generator()
+        self.max_peers = max_peers
+        self._masters = OrderedDict()
+
+    def master_secret(self, peer_pub):
+        """ Returns the secret shared with peer_pub, doing the ECDH on a cache miss. """
+        peer_id = peer_pub.export()
+        master = self._masters.pop(peer_id, None)
+        if master is None:
+            master = sha256((self.priv * peer_pub).export()).digest()
+            if len(self._masters) >= self.max_peers:
+                self._masters.popitem(last=False)
+        self._masters[peer_id] = master
+        return master
+
+    def message_key(self, sender_pub, recipient_pub, iv):
+        """ Derive the AES key of the message from sender_pub to
+            recipient_pub with this iv. One of the two must be self.pub. """
+        peer_pub = recipient_pub if sender_pub == self.pub else sender_pub
+        master = self.master_secret(peer_pub)
+        return sha256(master + sender_pub.export() + recipient_pub.export() + iv).digest()[:16]
+
+    def encrypt(self, peer_pub, message):
+        """ Encrypt a message for peer_pub, returning (iv, ciphertext, tag, pub). """
+        iv = urandom(16)
+        aes = Cipher("aes-128-gcm")
+        ciphertext, tag = aes.quick_gcm_enc(self.message_key(self.pub, peer_pub, iv), iv,
+                                            message.encode("utf8"))
+        return (iv, ciphertext, tag, self.pub)
+
+    def decrypt(self, ciphertext):
+        """ Decrypt a message from a peer's SessionKeys.encrypt.
+
+            In case the decryption fails, throw an exception.
+        """
+        iv, ciphertext, tag, peer_pub = ciphertext
+        aes = Cipher("aes-128-gcm")
+        key = self.message_key(peer_pub, self.pub, iv)
+        plain = aes.quick_gcm_dec(key, iv, ciphertext, tag)
+        return plain.decode("utf8")
+
+    def __len__(self):
+        return len(self._masters)
+
+def time_session_decrypt(repetitions=1000):
+    """ Compares messages/sec decrypted with a fresh ECDH per message, as
+        dh_decrypt does, against a SessionKeys cache. """
+    G, priv_a, _ = dh_get_key()
+    G, priv_b, pub_b = dh_get_key()
+    alice, bob = SessionKeys(priv_a), SessionKeys(priv_b)
+    messages = [alice.encrypt(bob.pub, u"Hello World") for _ in range(repetitions)]
+    aes = Cipher("aes-128-gcm")
+
+    start = timer()
+    for iv, ciphertext, tag, pub in messages:
+        master = sha256((priv_b * pub).export()).digest()
+        key = sha256(master + pub.export() + pub_b.export() + iv).digest()[:16]
+        aes.quick_gcm_dec(key, iv, ciphertext, tag)
+    before = repetitions / (timer() - start)
+
+    start = timer()
+    for message in messages:
+        bob.decrypt(message)
+    after = repetitions / (timer() - start)
+
+    return {"messages_per_second_ecdh": before,
+            "messages_per_second_session": after}
+
 ## NOTE: populate those (or more) tests
 #  ensure they run using the "py.test filename" command.
 #  What is your test coverage? Where is it missing cases?
@@ -379,5 +1801,237 @@ def test_fails():
 #           - Print reports on timing dependencies on secrets.
 #           - Fix one implementation to not leak information.
 
-def time_scalar_mul():
-    pass
+import csv
+import json
+import random
+
+try:
+    from time import perf_counter
+except ImportError:
+    from time import clock as perf_counter
+
+## Implementations compared by time_scalar_mul, all with the signature (a, b, p, x, y, scalar)
+SCALAR_MUL_IMPLEMENTATIONS = {
+    "double_and_add": point_scalar_multiplication_double_and_add,
+    "montgomerry_ladder": point_scalar_multiplication_montgomerry_ladder,
+    "double_and_add_jacobian": point_scalar_multiplication_double_and_add_jacobian,
+    "montgomerry_ladder_jacobian": point_scalar_multiplication_montgomerry_ladder_jacobian,
+    "montgomerry_ladder_ct": point_scalar_multiplication_montgomerry_ladder_ct,
+    "complete": point_scalar_multiplication_complete,
+    "wnaf": point_scalar_multiplication_wnaf,
+}
+
+## |t| above this is reported as a leak (the threshold used by dudect)
+LEAK_THRESHOLD = 4.5
+
+def _scalar_classes(order, rand):
+    """ Returns a function per class of scalars; each draws a fresh scalar
+        of that class below the group order. """
+    nbits = order.num_bits() - 1
+
+    def with_bits(positions):
+        return Bn.from_decimal(str(sum(2**i for i in positions)))
+
+    return {
+        "random": lambda: Bn.from_decimal(str(rand.getrandbits(nbits) | 2**(nbits - 1))),
+        "low_weight": lambda: with_bits([nbits - 1] + rand.sample(range(nbits - 1), 8)),
+        "high_weight": lambda: with_bits(set(range(nbits)) - set(rand.sample(range(nbits - 1), 8))),
+        "short": lambda: Bn.from_decimal(str(rand.getrandbits(nbits // 4) | 2**(nbits // 4 - 1))),
+    }
+
+def welch_t_test(xs, ys):
+    """ Welch's t statistic for the difference between the means of two samples. """
+    nx, ny = len(xs), len(ys)
+    mx, my = sum(xs) / float(nx), sum(ys) / float(ny)
+    vx = sum((v - mx)**2 for v in xs) / (nx - 1)
+    vy = sum((v - my)**2 for v in ys) / (ny - 1)
+    if vx + vy == 0:
+        return 0.0
+    return (mx - my) / ((vx / nx + vy / ny) ** 0.5)
+
+def time_scalar_mul(implementations=None, samples=50, nid=713,
+                    report_path=None, report_format="json"):
+    """
+    Times scalar multiplication implementations over classes of scalars
+    (random, low and high Hamming weight, short), and checks with Welch's
+    t-test whether each class takes a different time than random scalars.
+
+    Samples of all classes are interleaved in a random order, to spread
+    any drift of the machine evenly across classes.
+
+    Returns the report as a dict, and also writes it to report_path if
+    given, as JSON or as CSV (one row per implementation and class).
+    """
+    if implementations is None:
+        implementations = sorted(SCALAR_MUL_IMPLEMENTATIONS)
+
+    G = EcGroup(nid)
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    x, y = G.generator().get_affine()
+
+    rand = random.SystemRandom()
+    classes = _scalar_classes(G.order(), rand)
+
+    report = {"curve": nid, "samples": samples, "threshold": LEAK_THRESHOLD,
+              "implementations": {}}
+
+    for name in implementations:
+        scalar_mul = SCALAR_MUL_IMPLEMENTATIONS[name]
+
+        schedule = sorted(classes) * samples
+        rand.shuffle(schedule)
+        timings = dict((cls, []) for cls in classes)
+        for cls in schedule:
+            scalar = classes[cls]()
+            start = perf_counter()
+            scalar_mul(a, b, p, x, y, scalar)
+            timings[cls].append(perf_counter() - start)
+
+        results = {}
+        for cls, xs in timings.items():
+            mean = sum(xs) / len(xs)
+            stdev = (sum((v - mean)**2 for v in xs) / (len(xs) - 1)) ** 0.5
+            results[cls] = {"mean": mean, "stdev": stdev, "ops_per_second": 1.0 / mean}
+            if cls != "random":
+                t = welch_t_test(xs, timings["random"])
+                results[cls]["t_vs_random"] = t
+                results[cls]["leak"] = abs(t) > LEAK_THRESHOLD
+
+        report["implementations"][name] = {
+            "classes": results,
+            "leak": any(r.get("leak", False) for r in results.values())}
+
+    if report_path is not None:
+        _write_timing_report(report, report_path, report_format)
+    return report
+
+def _write_timing_report(report, report_path, report_format):
+    if report_format == "json":
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    elif report_format == "csv":
+        fields = ["implementation", "class", "mean", "stdev", "ops_per_second", "t_vs_random", "leak"]
+        with open(report_path, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for name, result in sorted(report["implementations"].items()):
+                for cls, row in sorted(result["classes"].items()):
+                    row = dict(row, implementation=name)
+                    row["class"] = cls
+                    writer.writerow(row)
+    else:
+        raise Exception("Unknown report format: %s" % report_format)
+
+def time_field_backends(nids=(409, 713, 415, 715, 716), repetitions=5):
+    """ Reports ops/sec of point_add, point_double and the wNAF scalar
+        multiplication with each field backend, for curves of increasing
+        size (by default the NIST P-192, P-224, P-256, P-384 and P-521 curves). """
+    previous = get_field_backend()
+    report = []
+    try:
+        for nid in nids:
+            G = EcGroup(nid)
+            d = G.parameters()
+            a, b, p = d["a"], d["b"], d["p"]
+            g = G.generator()
+            x0, y0 = g.get_affine()
+            x1, y1 = (G.order().random() * g).get_affine()
+            scalar = G.order().random()
+
+            operations = [
+                ("point_add", lambda: point_add(a, b, p, x0, y0, x1, y1), 100 * repetitions),
+                ("point_double", lambda: point_double(a, b, p, x0, y0), 100 * repetitions),
+                ("scalar_mul_wnaf", lambda: point_scalar_multiplication_wnaf(a, b, p, x0, y0, scalar),
+                 repetitions),
+            ]
+
+            for backend in sorted(FIELD_BACKENDS):
+                set_field_backend(backend)
+                row = {"curve": nid, "bits": p.num_bits(), "backend": backend}
+                for name, operation, count in operations:
+                    start = timer()
+                    for _ in range(count):
+                        operation()
+                    row[name + "_per_second"] = count / (timer() - start)
+                report.append(row)
+    finally:
+        set_field_backend(previous)
+    return report
+
+def time_complete_formulas(repetitions=200, scalar_repetitions=5, nid=713):
+    """ Compares the complete projective formulas with the affine and Jacobian
+        ones (ops/sec per formula), and the complete double-and-add-always
+        with the other scalar multiplications, on the selected field backend. """
+    G = EcGroup(nid)
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    x0, y0 = g.get_affine()
+    x1, y1 = (G.order().random() * g).get_affine()
+    scalar = G.order().random()
+
+    fa, fb, fp, fx0, fy0, fx1, fy1 = _to_field(a, b, p, x0, y0, x1, y1)
+    J0, J1 = to_jacobian(fx0, fy0), to_jacobian(fx1, fy1)
+    P0, P1 = to_projective(fx0, fy0), to_projective(fx1, fy1)
+
+    formulas = [
+        ("affine_add", lambda: _point_add_unchecked(fa, fb, fp, fx0, fy0, fx1, fy1)),
+        ("affine_double", lambda: _point_double_unchecked(fa, fb, fp, fx0, fy0)),
+        ("jacobian_add", lambda: jacobian_point_add(fa, fb, fp, *(J0 + J1))),
+        ("jacobian_double", lambda: jacobian_point_double(fa, fb, fp, *J0)),
+        ("complete_add", lambda: complete_point_add(fa, fb, fp, *(P0 + P1))),
+        ("complete_double", lambda: complete_point_double(fa, fb, fp, *P0)),
+    ]
+    scalar_muls = [
+        ("double_and_add", point_scalar_multiplication_double_and_add),
+        ("montgomerry_ladder_jacobian", point_scalar_multiplication_montgomerry_ladder_jacobian),
+        ("montgomerry_ladder_ct", point_scalar_multiplication_montgomerry_ladder_ct),
+        ("complete", point_scalar_multiplication_complete),
+    ]
+
+    report = {"curve": nid, "backend": get_field_backend()}
+    for name, formula in formulas:
+        start = timer()
+        for _ in range(repetitions):
+            formula()
+        report[name + "_per_second"] = repetitions / (timer() - start)
+    for name, scalar_mul in scalar_muls:
+        start = timer()
+        for _ in range(scalar_repetitions):
+            scalar_mul(a, b, p, x0, y0, scalar)
+        report["scalar_mul_" + name + "_per_second"] = scalar_repetitions / (timer() - start)
+    return report
+
+def time_multi_scalar_mul(sizes=(2, 10, 100, 1000, 10000), naive_limit=100, nid=713):
+    """ Times multi_scalar_multiplication for each number of terms in sizes,
+        against independent wNAF multiplications summed up (only up to
+        naive_limit terms, as it gets slow). Returns one dict per size. """
+    G = EcGroup(nid)
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    o = G.order()
+
+    report = []
+    for n in sizes:
+        points = [(o.random() * g).get_affine() for _ in range(n)]
+        scalars = [o.random() for _ in range(n)]
+
+        start = timer()
+        multi_scalar_multiplication(a, b, p, points, scalars)
+        row = {"terms": n,
+               "method": "pippenger" if n > PIPPENGER_THRESHOLD else "straus",
+               "msm_seconds": timer() - start}
+
+        if n <= naive_limit:
+            start = timer()
+            Q = to_jacobian(None, None)
+            for (x, y), k in zip(points, scalars):
+                xk, yk = point_scalar_multiplication_wnaf(a, b, p, x, y, k)
+                Q = jacobian_point_mixed_add(a, b, p, Q[0], Q[1], Q[2], xk, yk)
+            from_jacobian(p, Q[0], Q[1], Q[2])
+            row["naive_seconds"] = timer() - start
+
+        report.append(row)
+    return report
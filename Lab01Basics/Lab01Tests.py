@@ -101,6 +101,123 @@ def test_gcm_fails():
     assert 'decryption failed' in str(excinfo.value)
 
 
+@pytest.mark.task2
+def test_bulk_encrypt_decrypt():
+    """ Tests bulk encryption of many messages into a packed buffer """
+    from pytest import raises
+    from os import urandom
+    K = urandom(16)
+    messages = [u"Hello World!", u"", u"\u00e9t\u00e9", u"Test" * 1000]
+
+    packed = encrypt_messages(K, messages)
+    assert len(packed) == 12 + sum(4 + len(m.encode("utf8")) + 16 for m in messages)
+    assert decrypt_messages(K, packed) == messages
+    assert decrypt_messages(K, encrypt_messages(K, [])) == []
+
+    with raises(Exception) as excinfo:
+        decrypt_messages(urandom(16), packed)
+    assert 'decryption failed' in str(excinfo.value)
+
+    tampered = bytearray(packed)
+    tampered[20] ^= 1
+    with raises(Exception) as excinfo:
+        decrypt_messages(K, bytes(tampered))
+    assert 'decryption failed' in str(excinfo.value)
+
+    with raises(Exception) as excinfo:
+        decrypt_messages(K, packed[:-1])
+    assert 'truncated' in str(excinfo.value)
+
+    # Dropping the last record and fixing up the count is detected
+    from struct import pack
+    last = 4 + len(messages[-1].encode("utf8")) + 16
+    shortened = packed[:8] + pack("!I", len(messages) - 1) + packed[12:-last]
+    with raises(Exception) as excinfo:
+        decrypt_messages(K, shortened)
+    assert 'decryption failed' in str(excinfo.value)
+
+@pytest.mark.task2
+def test_stream_roundtrip():
+    """ Tests chunked streaming encryption with file-like objects and iterables """
+    from io import BytesIO
+    from os import urandom
+    K = urandom(16)
+
+    for size in [0, 1, 100, 1024, 3000]:
+        message = urandom(size)
+        encrypted = BytesIO()
+        assert encrypt_stream(K, BytesIO(message), encrypted, chunk_size=1024) == size
+
+        decrypted = BytesIO()
+        assert decrypt_stream(K, BytesIO(encrypted.getvalue()), decrypted) == size
+        assert decrypted.getvalue() == message
+
+    ## Iterables of chunks of any size, in and out
+    message = urandom(5000)
+    pieces = [message[i:i + 333] for i in range(0, len(message), 333)]
+    encrypted = BytesIO()
+    encrypt_stream(K, pieces, encrypted, chunk_size=1000)
+
+    data = encrypted.getvalue()
+    decrypted = BytesIO()
+    decrypt_stream(K, [data[i:i + 77] for i in range(0, len(data), 77)], decrypted)
+    assert decrypted.getvalue() == message
+
+@pytest.mark.task2
+def test_stream_fails():
+    """ Tests that tampered, truncated or extended streams are rejected """
+    from pytest import raises
+    from io import BytesIO
+    from os import urandom
+    K = urandom(16)
+
+    encrypted = BytesIO()
+    encrypt_stream(K, BytesIO(urandom(3000)), encrypted, chunk_size=1000)
+    data = encrypted.getvalue()
+    frame = 4 + 1000 + 16
+    header = len(data) - 3 * frame
+
+    ## Bad key
+    with raises(Exception) as excinfo:
+        decrypt_stream(urandom(16), BytesIO(data), BytesIO())
+    assert 'decryption failed' in str(excinfo.value)
+
+    ## Flipped ciphertext byte in the second chunk: the first chunk is still output
+    tampered = bytearray(data)
+    tampered[header + frame + 10] ^= 1
+    out = BytesIO()
+    with raises(Exception) as excinfo:
+        decrypt_stream(K, BytesIO(bytes(tampered)), out)
+    assert 'decryption failed' in str(excinfo.value)
+    assert len(out.getvalue()) == 1000
+
+    ## Dropped last chunk, swapped chunks and trailing data
+    for bad in [data[:header + 2 * frame],
+                data[:header] + data[header + frame:header + 2 * frame]
+                    + data[header:header + frame] + data[header + 2 * frame:],
+                data + data[header:header + frame]]:
+        with raises(Exception) as excinfo:
+            decrypt_stream(K, BytesIO(bad), BytesIO())
+        assert 'decryption failed' in str(excinfo.value)
+
+    ## Cut inside a frame
+    with raises(Exception) as excinfo:
+        decrypt_stream(K, BytesIO(data[:-5]), BytesIO())
+    assert 'truncated' in str(excinfo.value)
+
+    ## Forged chunk size in the header: larger ones are authenticated,
+    ## oversized ones are refused before reading any frame
+    from struct import pack
+    for chunk_size, error in [(2000, 'decryption failed'), (0xFFFFFFFF, 'too large')]:
+        forged = data[:7] + pack("!I", chunk_size) + data[11:]
+        with raises(Exception) as excinfo:
+            decrypt_stream(K, BytesIO(forged), BytesIO())
+        assert error in str(excinfo.value)
+
+    with raises(Exception) as excinfo:
+        encrypt_stream(K, BytesIO(b"data"), BytesIO(), chunk_size=STREAM_MAX_CHUNK + 1)
+    assert 'invalid chunk size' in str(excinfo.value)
+
 #####################################################
 # TASK 3 -- Understand Elliptic Curve Arithmetic
 #           - Test if a point is on a curve.
@@ -275,6 +392,335 @@ def test_Point_scalar_mult_montgomerry_ladder():
     assert gx2 == x2
     assert gy2 == y2
 
+@pytest.mark.task3
+def test_Point_validated():
+    """
+    Test that validated points are checked once and then trusted.
+    """
+    from pytest import raises
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    gx1, gy1 = (G.order().random() * g).get_affine()
+
+    with raises(Exception) as excinfo:
+        validate_point(a, b, p, gx0, gy0 + 1)
+    assert 'Point must be on curve' in str(excinfo.value)
+
+    with raises(Exception) as excinfo:
+        point_scalar_multiplication_double_and_add(a, b, p, gx0, gy0 + 1, Bn(5))
+    assert 'Point must be on curve' in str(excinfo.value)
+
+    P = validate_point(a, b, p, gx0, gy0)
+    Q = validate_point(a, b, p, gx1, gy1)
+
+    R = validated_point_add(P, Q)
+    assert isinstance(R, ValidatedPoint)
+    assert (R.x, R.y) == point_add(a, b, p, gx0, gy0, gx1, gy1)
+
+    P2 = validated_point_double(P)
+    assert (P2.x, P2.y) == (2 * g).get_affine()
+    assert validated_point_add(P, P) == P2
+
+    with raises(Exception) as excinfo:
+        validated_point_add(P, (gx1, gy1))
+    assert 'validated' in str(excinfo.value)
+
+@pytest.mark.task3
+def test_Point_jacobian_add_double():
+    """
+    Test the Jacobian addition, mixed addition and doubling against the affine ones.
+    """
+
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    gx1, gy1 = (G.order().random() * g).get_affine()
+
+    P = to_jacobian(gx0, gy0)
+    Q = to_jacobian(gx1, gy1)
+    P2 = jacobian_point_double(a, b, p, P[0], P[1], P[2])
+
+    assert from_jacobian(p, *P2) == point_double(a, b, p, gx0, gy0)
+    assert from_jacobian(p, *jacobian_point_add(a, b, p, P[0], P[1], P[2], Q[0], Q[1], Q[2])) \
+           == point_add(a, b, p, gx0, gy0, gx1, gy1)
+
+    ## Mixed addition onto a point with Z != 1
+    assert from_jacobian(p, *jacobian_point_mixed_add(a, b, p, P2[0], P2[1], P2[2], gx0, gy0)) \
+           == (3 * g).get_affine()
+
+    ## Adding a point to itself doubles, adding its negation gives infinity
+    assert from_jacobian(p, *jacobian_point_add(a, b, p, P[0], P[1], P[2], P[0], P[1], P[2])) \
+           == (2 * g).get_affine()
+    assert from_jacobian(p, *jacobian_point_mixed_add(a, b, p, P[0], P[1], P[2], gx0, p - gy0)) \
+           == (None, None)
+
+@pytest.mark.task3
+def test_batch_normalisation():
+    """
+    Test the simultaneous inversion and batch conversion back to affine.
+    """
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+
+    values = [p.random() for _ in range(5)] + [Bn(0), p]
+    inverses = batch_mod_inverse(p, values)
+    for v, v_inv in zip(values[:5], inverses[:5]):
+        assert v_inv == v.mod_inverse(p)
+    assert inverses[5:] == [None, None]
+    assert batch_mod_inverse(p, []) == []
+
+    gx, gy = g.get_affine()
+    P = to_jacobian(gx, gy)
+    points = [P, jacobian_point_double(a, b, p, *P), to_jacobian(None, None)]
+    assert batch_from_jacobian(p, points) == [from_jacobian(p, *pt) for pt in points]
+
+@pytest.mark.task3
+def test_batch_Point_scalar_mult():
+    """
+    Test the batched scalar multiplication.
+    """
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    o = G.order()
+
+    pts = [o.random() * g for _ in range(4)]
+    scalars = [o.random() for _ in range(4)]
+    points = [pt.get_affine() for pt in pts] + [(None, None), g.get_affine()]
+    scalars += [Bn(5), Bn(0)]
+
+    expected = [(k * pt).get_affine() for k, pt in zip(scalars, pts)] + [(None, None)] * 2
+    assert batch_point_scalar_multiplication(a, b, p, points, scalars) == expected
+
+@pytest.mark.task3
+def test_Point_scalar_mult_jacobian():
+    """
+    Test that the Jacobian scalar multiplications agree with the affine ones.
+    """
+
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    r = G.order().random()
+
+    gx2, gy2 = (r*g).get_affine()
+
+    assert point_scalar_multiplication_double_and_add_jacobian(a, b, p, gx0, gy0, r) == (gx2, gy2)
+    assert point_scalar_multiplication_montgomerry_ladder_jacobian(a, b, p, gx0, gy0, r) == (gx2, gy2)
+
+    assert point_scalar_multiplication_double_and_add_jacobian(a, b, p, gx0, gy0, Bn(0)) == (None, None)
+    assert point_scalar_multiplication_montgomerry_ladder_jacobian(a, b, p, gx0, gy0, G.order()) \
+           == (None, None)
+
+@pytest.mark.task3
+def test_Point_scalar_mult_montgomerry_ladder_ct():
+    """
+    Test the fixed-length Montgomery ladder with complete formulas.
+    """
+    from pytest import raises
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    r = G.order().random()
+
+    assert point_scalar_multiplication_montgomerry_ladder_ct(a, b, p, gx0, gy0, r) \
+           == (r * g).get_affine()
+
+    for k in [0, 1, 2, 3]:
+        expected = (None, None) if k == 0 else (k * g).get_affine()
+        assert point_scalar_multiplication_montgomerry_ladder_ct(a, b, p, gx0, gy0, Bn(k)) == expected
+
+    assert point_scalar_multiplication_montgomerry_ladder_ct(a, b, p, gx0, gy0, G.order()) \
+           == (None, None)
+    assert point_scalar_multiplication_montgomerry_ladder_ct(a, b, p, None, None, r) == (None, None)
+
+    with raises(Exception) as excinfo:
+        point_scalar_multiplication_montgomerry_ladder_ct(a, b, p, gx0, gy0, r, num_bits=8)
+    assert 'Scalar too large' in str(excinfo.value)
+
+@pytest.mark.task3
+def test_complete_formulas():
+    """
+    Test the complete projective formulas on the special cases of point_add.
+    """
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    gx1, gy1 = (G.order().random() * g).get_affine()
+
+    P = to_projective(gx0, gy0)
+    Q = to_projective(gx1, gy1)
+    inf = to_projective(None, None)
+
+    assert from_projective(p, *complete_point_add(a, b, p, *(P + Q))) \
+           == point_add(a, b, p, gx0, gy0, gx1, gy1)
+    assert from_projective(p, *complete_point_add(a, b, p, *(P + P))) == (2 * g).get_affine()
+    assert from_projective(p, *complete_point_double(a, b, p, *P)) == (2 * g).get_affine()
+    assert from_projective(p, *complete_point_add(a, b, p, *(P + (gx0, p - gy0, 1)))) == (None, None)
+    assert from_projective(p, *complete_point_add(a, b, p, *(P + inf))) == (gx0, gy0)
+    assert from_projective(p, *complete_point_add(a, b, p, *(inf + inf))) == (None, None)
+    assert from_projective(p, *complete_point_double(a, b, p, *inf)) == (None, None)
+
+    ## Conversions between the Jacobian and projective models
+    J = jacobian_point_double(a, b, p, *to_jacobian(gx0, gy0))
+    assert from_projective(p, *jacobian_to_projective(p, *J)) == from_jacobian(p, *J)
+    P2 = complete_point_double(a, b, p, *P)
+    assert from_jacobian(p, *projective_to_jacobian(p, *P2)) == from_projective(p, *P2)
+
+@pytest.mark.task3
+def test_Point_scalar_mult_complete():
+    """
+    Test the double-and-add-always scalar multiplication with complete formulas.
+    """
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    r = G.order().random()
+
+    assert point_scalar_multiplication_complete(a, b, p, gx0, gy0, r) == (r * g).get_affine()
+    assert point_scalar_multiplication_complete(a, b, p, gx0, gy0, Bn(0)) == (None, None)
+    assert point_scalar_multiplication_complete(a, b, p, gx0, gy0, G.order()) == (None, None)
+
+@pytest.mark.task3
+def test_wnaf_recode():
+    """
+    Test that the width-w NAF digits are valid and add up to the scalar.
+    """
+    from petlib.ec import EcGroup
+    r = EcGroup(713).order().random()
+
+    for w in range(2, 7):
+        digits = wnaf_recode(r, w)
+        assert sum(d * 2**i for i, d in enumerate(digits)) == int(r)
+        assert all(d % 2 == 1 and abs(d) < 2**(w - 1) for d in digits if d != 0)
+        for i, d in enumerate(digits):
+            if d != 0:
+                assert not any(digits[i + 1:i + w])
+
+    assert wnaf_recode(Bn(0), 4) == []
+    assert wnaf_recode(Bn(7), 2) == [-1, 0, 0, 1]
+
+@pytest.mark.task3
+def test_Point_scalar_mult_wnaf():
+    """
+    Test the scalar multiplication using width-w NAF.
+    """
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    r = G.order().random()
+
+    gx2, gy2 = (r*g).get_affine()
+
+    for w in range(2, 7):
+        assert point_scalar_multiplication_wnaf(a, b, p, gx0, gy0, r, w) == (gx2, gy2)
+
+    assert point_scalar_multiplication_wnaf(a, b, p, gx0, gy0, Bn(0)) == (None, None)
+    assert point_scalar_multiplication_wnaf(a, b, p, gx0, gy0, G.order()) == (None, None)
+
+@pytest.mark.task3
+def test_multi_scalar_multiplication():
+    """
+    Test the multi-scalar multiplication, with both Straus and Pippenger.
+    """
+    import Lab01Code
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    o = G.order()
+
+    pts = [o.random() * g for _ in range(12)]
+    scalars = [o.random() for _ in range(12)]
+    expected = G.wsum(scalars, pts).get_affine()
+    points = [pt.get_affine() for pt in pts]
+
+    assert multi_scalar_multiplication(a, b, p, points, scalars) == expected
+    assert from_jacobian(p, *Lab01Code._multi_scalar_pippenger(a, b, p, points, scalars)) \
+           == expected
+
+    ## Infinity points, zero scalars and repeated points
+    gx, gy = g.get_affine()
+    assert multi_scalar_multiplication(a, b, p, [(gx, gy), (None, None), (gx, gy)],
+                                       [Bn(2), Bn(5), Bn(3)]) == (5 * g).get_affine()
+    assert multi_scalar_multiplication(a, b, p, [(gx, gy)], [Bn(0)]) == (None, None)
+    assert multi_scalar_multiplication(a, b, p, [(gx, gy), (gx, p - gy)],
+                                       [Bn(7), Bn(7)]) == (None, None)
+
+@pytest.fixture
+def int_field_backend():
+    set_field_backend("int")
+    yield
+    set_field_backend("bn")
+
+@pytest.mark.task3
+def test_field_backends(int_field_backend):
+    """
+    Test that the curve arithmetic gives the same Bn results on the int backend.
+    """
+    from pytest import raises
+    from petlib.ec import EcGroup
+    G = EcGroup(713) # NIST curve
+    d = G.parameters()
+    a, b, p = d["a"], d["b"], d["p"]
+    g = G.generator()
+    gx0, gy0 = g.get_affine()
+    r = G.order().random()
+    gx1, gy1 = (r * g).get_affine()
+
+    assert get_field_backend() == "int"
+
+    x, y = point_add(a, b, p, gx0, gy0, gx1, gy1)
+    assert isinstance(x, Bn) and isinstance(y, Bn)
+    assert (x, y) == ((r + 1) * g).get_affine()
+    assert point_double(a, b, p, gx0, gy0) == (2 * g).get_affine()
+
+    for scalar_mul in [point_scalar_multiplication_double_and_add,
+                       point_scalar_multiplication_montgomerry_ladder,
+                       point_scalar_multiplication_double_and_add_jacobian,
+                       point_scalar_multiplication_montgomerry_ladder_jacobian,
+                       point_scalar_multiplication_montgomerry_ladder_ct,
+                       point_scalar_multiplication_wnaf]:
+        x, y = scalar_mul(a, b, p, gx0, gy0, r)
+        assert isinstance(x, Bn)
+        assert (x, y) == (gx1, gy1)
+
+    assert batch_point_scalar_multiplication(a, b, p, [(gx0, gy0)], [r]) == [(gx1, gy1)]
+    assert multi_scalar_multiplication(a, b, p, [(gx0, gy0), (gx1, gy1)], [r, Bn(1)]) \
+           == (2 * r * g).get_affine()
+
+    with raises(Exception) as excinfo:
+        set_field_backend("float")
+    assert 'Unknown field backend' in str(excinfo.value)
+
 #####################################################
 # TASK 4 -- Standard ECDSA signatures
 #
@@ -289,6 +735,17 @@ def test_key_gen():
     from Lab01Code import ecdsa_key_gen
     G, priv, pub = ecdsa_key_gen()
 
+@pytest.mark.task4
+def test_get_group():
+    """ Tests the shared group and key generation on it """
+    G = get_group()
+    assert get_group() is G
+    assert get_group(409).nid() == 409
+
+    G, priv, pub = ecdsa_key_gen()
+    assert G is get_group()
+    assert pub == priv * G.generator()
+
 @pytest.mark.task4
 def test_produce_signature():
     """ Tests signature function """
@@ -321,6 +778,48 @@ def test_check_fail():
 
     assert not ecdsa_verify(G, pub, msg2, sig)
 
+@pytest.mark.task4
+def test_ecdsa_sign_pool():
+    """ Signatures made with precomputed nonces verify, and nonces are not reused """
+    msg = u"Test" * 1000
+    G, priv, pub = ecdsa_key_gen()
+
+    pool = ecdsa_sign_pool(G, priv, low=2, high=5)
+    try:
+        assert pool.wait_full(timeout=10)
+        sigs = [ecdsa_sign(G, priv, msg, pool=pool) for _ in range(8)]
+        assert all(ecdsa_verify(G, pub, msg, sig) for sig in sigs)
+        assert len(set(r for r, s in sigs)) == len(sigs)
+        assert pool.wait_full(timeout=10)
+    finally:
+        pool.stop()
+    assert len(pool) == 0
+
+@pytest.mark.task4
+def test_ecdsa_verify_batch():
+    """ Batch verification reports one result per item, in order """
+    signers = [ecdsa_key_gen() for _ in range(3)]
+    items = []
+    for i in range(10):
+        G, priv, pub = signers[i % 3]
+        msg = u"Message %d" % i
+        items.append((pub, msg, ecdsa_sign(G, priv, msg)))
+
+    # Wrong message, wrong key and a signature from another item
+    items[2] = (items[2][0], u"Other", items[2][2])
+    items[4] = (signers[0][2], items[4][1], items[4][2])
+    items[7] = (items[7][0], items[7][1], items[8][2])
+    # Malformed signatures and items
+    items[5] = (items[5][0], items[5][1], None)
+    items[6] = (items[6][0], items[6][1], (Bn(1),))
+    items[9] = None
+    expected = [i not in (2, 4, 5, 6, 7, 9) for i in range(10)]
+
+    assert ecdsa_verify_batch(G, items) == expected
+    assert ecdsa_verify_batch(G, items, chunk_size=2) == expected
+    assert ecdsa_verify_batch(G, items, processes=2) == expected
+    assert ecdsa_verify_batch(G, []) == []
+
 
 #####################################################
 # TASK 5 -- Diffie-Hellman Key Exchange and Derivation
@@ -331,3 +830,153 @@ def test_check_fail():
 @pytest.mark.task5
 def test_key_gen():
     G, priv, pub = dh_get_key()
+
+@pytest.mark.task5
+def test_dh_key_pool():
+    from hashlib import sha256
+    from petlib.cipher import Cipher
+    from pytest import raises
+
+    with raises(Exception) as excinfo:
+        dh_key_pool(low=4, high=4)
+    assert 'Watermarks' in str(excinfo.value)
+
+    G, priv_b, pub_b = dh_get_key()
+    pool = dh_key_pool(low=1, high=3)
+    try:
+        assert pool.wait_full(timeout=10)
+        pairs = [pool.take() for _ in range(5)]
+        assert all(pub == priv * G.generator() for priv, pub in pairs)
+
+        assert pool.wait_full(timeout=10)
+        iv, ciphertext, tag, pub_a = dh_encrypt(pub_b, u"Hello World", pool=pool)
+        assert len(pool) == 2
+    finally:
+        pool.stop()
+
+    key = sha256((priv_b * pub_a).export()).digest()[:16]
+    aes = Cipher("aes-128-gcm")
+    assert aes.quick_gcm_dec(key, iv, ciphertext, tag) == b"Hello World"
+
+@pytest.mark.task5
+def test_dh_multi_recipient():
+    from pytest import raises
+    keys = [dh_get_key() for _ in range(3)]
+    pubs = [pub for G, priv, pub in keys]
+
+    message = u"Hello everyone \u00e9"
+    ciphertext = dh_encrypt_multi(pubs, message)
+    iv, body, tag, pub_a, wrapped_keys = ciphertext
+    assert len(wrapped_keys) == 3
+    assert len(body) == len(message.encode("utf8"))
+
+    for G, priv, pub in keys:
+        assert dh_decrypt_multi(priv, ciphertext) == message
+
+    G, outsider, _ = dh_get_key()
+    with raises(Exception) as excinfo:
+        dh_decrypt_multi(outsider, ciphertext)
+    assert 'Not a recipient' in str(excinfo.value)
+
+    bad_body = (iv, body[:-1] + bytes(bytearray([body[-1] ^ 1])), tag, pub_a, wrapped_keys)
+    with raises(Exception) as excinfo:
+        dh_decrypt_multi(keys[0][1], bad_body)
+    assert 'decryption failed' in str(excinfo.value)
+
+@pytest.mark.task5
+def test_dh_decrypt_parallel():
+    G, priv, pub = dh_get_key()
+    messages = [u"Message %d" % i for i in range(9)]
+    ciphertexts = [dh_encrypt(pub, m) for m in messages]
+
+    iv, ciphertext, tag, pub_a = ciphertexts[3]
+    ciphertexts[3] = (iv, ciphertext, tag[::-1], pub_a)
+    ciphertexts[6] = (iv, ciphertext, tag, pub_a, "extra")
+
+    for processes in (1, 2):
+        results = dh_decrypt_parallel(priv, ciphertexts, processes=processes, chunk_size=2)
+        assert len(results) == 9
+        for i, result in enumerate(results):
+            if i in (3, 6):
+                assert result.message is None and result.error
+            else:
+                assert result == (messages[i], None)
+
+    assert 'decryption failed' in results[3].error
+    assert dh_decrypt_parallel(priv, iter([]), processes=2) == []
+
+@pytest.mark.task5
+def test_session_keys():
+    from pytest import raises
+    G, priv_a, _ = dh_get_key()
+    alice = SessionKeys(priv_a)
+    bobs = [SessionKeys(dh_get_key()[1], max_peers=2) for _ in range(2)]
+
+    first = alice.encrypt(bobs[0].pub, u"Hello Bob")
+    second = alice.encrypt(bobs[0].pub, u"Hello Bob")
+    assert first[3] == alice.pub
+    assert first[1] != second[1]
+    assert bobs[0].decrypt(first) == u"Hello Bob"
+    assert bobs[0].decrypt(second) == u"Hello Bob"
+    assert len(bobs[0]) == 1
+
+    with raises(Exception) as excinfo:
+        bobs[1].decrypt(first)
+    assert 'decryption failed' in str(excinfo.value)
+
+    # A message reflected back to its sender, claiming to be from Bob
+    iv, ciphertext, tag, _ = alice.encrypt(bobs[0].pub, u"Hello Bob")
+    with raises(Exception) as excinfo:
+        alice.decrypt((iv, ciphertext, tag, bobs[0].pub))
+    assert 'decryption failed' in str(excinfo.value)
+    assert alice.decrypt(bobs[0].encrypt(alice.pub, u"Hello Alice")) == u"Hello Alice"
+
+    # The least recently used peer is evicted, and recomputed on demand
+    bob = bobs[0]
+    others = [SessionKeys(dh_get_key()[1]) for _ in range(2)]
+    bob.master_secret(alice.pub)
+    bob.master_secret(others[0].pub)
+    bob.master_secret(alice.pub)
+    bob.master_secret(others[1].pub)
+    assert len(bob) == 2
+    assert others[0].pub.export() not in bob._masters
+    assert alice.pub.export() in bob._masters
+    assert bob.master_secret(others[0].pub) == others[0].master_secret(bob.pub)
+
+    with raises(Exception) as excinfo:
+        SessionKeys(priv_a, max_peers=0)
+    assert 'at least one peer' in str(excinfo.value)
+
+
+#####################################################
+# TASK 6 -- Time EC scalar multiplication
+
+@pytest.mark.task6
+def test_welch_t_test():
+    assert welch_t_test([1.0, 2.0, 3.0], [1.0, 2.0, 3.0]) == 0
+    assert welch_t_test([10.0, 11.0, 12.0], [1.0, 2.0, 3.0]) > 4.5
+    assert welch_t_test([5.0, 5.0], [5.0, 5.0]) == 0
+
+@pytest.mark.task6
+def test_time_scalar_mul_report(tmpdir):
+    import json
+    import csv
+
+    path = str(tmpdir.join("report.json"))
+    report = time_scalar_mul(["montgomerry_ladder_ct"], samples=3, report_path=path)
+
+    result = report["implementations"]["montgomerry_ladder_ct"]
+    assert sorted(result["classes"]) == ["high_weight", "low_weight", "random", "short"]
+    assert all(r["ops_per_second"] > 0 for r in result["classes"].values())
+    assert "t_vs_random" in result["classes"]["short"]
+    assert json.load(open(path)) == json.loads(json.dumps(report))
+
+    report = time_scalar_mul(["complete"], samples=3)
+    assert sorted(report["implementations"]["complete"]["classes"]) == \
+        ["high_weight", "low_weight", "random", "short"]
+
+    path = str(tmpdir.join("report.csv"))
+    time_scalar_mul(["wnaf"], samples=3, report_path=path, report_format="csv")
+    rows = list(csv.DictReader(open(path)))
+    assert len(rows) == 4
+    assert set(r["implementation"] for r in rows) == set(["wnaf"])
@@ -18,7 +18,7 @@
 
 from collections import namedtuple
 from hashlib import sha512
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 from binascii import hexlify
 
 def aes_ctr_enc_dec(key, iv, input):
@@ -53,7 +53,7 @@ from petlib.ec import EcGroup
 from petlib.hmac import Hmac, secure_compare
 from petlib.cipher import Cipher
 
-def mix_server_one_hop(private_key, message_list):
+def mix_server_one_hop(private_key, message_list, replay_filter=None):
     """ Implements the decoding for a simple one-hop mix. 
 
         Each message is decoded in turn:
@@ -61,53 +61,70 @@ def mix_server_one_hop(private_key, message_list):
         - the hmac is checked against all encrypted parts of the message
         - the address and message are decrypted, decoded and returned
 
+        Optionally, messages already seen by the replay_filter are dropped.
     """
     G = EcGroup()
+    round_filter = _RoundReplays(replay_filter) if replay_filter is not None else None
 
     out_queue = []
 
     # Process all messages
     for msg in message_list:
+        output = _mix_one_hop_decode(G, private_key, msg, round_filter)
+        if output is not None:
+            out_queue += [output]
 
-        ## Check elements and lengths
-        if not G.check_point(msg.ec_public_key) or \
-               not len(msg.hmac) == 20 or \
-               not len(msg.address) == 258 or \
-               not len(msg.message) == 1002:
-           raise Exception("Malformed input message")
+    if round_filter is not None:
+        round_filter.commit()
+    return sorted(out_queue)
 
-        ## First get a shared key
-        shared_element = private_key * msg.ec_public_key
-        key_material = sha512(shared_element.export()).digest()
+def _mix_one_hop_decode(G, private_key, msg, replay_filter=None):
+    """ Decodes a single OneHopMixMessage into an (address, message) tuple,
+    or None if the replay_filter has seen it before. """
 
-        # Use different parts of the shared key for different operations
-        hmac_key = key_material[:16]
-        address_key = key_material[16:32]
-        message_key = key_material[32:48]
+    ## Check elements and lengths
+    if not G.check_point(msg.ec_public_key) or \
+           not len(msg.hmac) == 20 or \
+           not len(msg.address) == 258 or \
+           not len(msg.message) == 1002:
+       raise Exception("Malformed input message")
 
-        ## Check the HMAC
-        h = Hmac(b"sha512", hmac_key)        
-        h.update(msg.address)
-        h.update(msg.message)
-        expected_mac = h.digest()
+    ## First get a shared key
+    shared_element = private_key * msg.ec_public_key
+    key_material = sha512(shared_element.export()).digest()
 
-        if not secure_compare(msg.hmac, expected_mac[:20]):
-            raise Exception("HMAC check failure")
+    # Drop replays before doing any more work
+    if replay_filter is not None and key_material in replay_filter:
+        return None
 
-        ## Decrypt the address and the message
-        iv = b"\x00"*16
+    # Use different parts of the shared key for different operations
+    hmac_key = key_material[:16]
+    address_key = key_material[16:32]
+    message_key = key_material[32:48]
 
-        address_plaintext = aes_ctr_enc_dec(address_key, iv, msg.address)
-        message_plaintext = aes_ctr_enc_dec(message_key, iv, msg.message)
+    ## Check the HMAC
+    h = Hmac(b"sha512", hmac_key)        
+    h.update(msg.address)
+    h.update(msg.message)
+    expected_mac = h.digest()
 
-        # Decode the address and message
-        address_len, address_full = unpack("!H256s", address_plaintext)
-        message_len, message_full = unpack("!H1000s", message_plaintext)
+    if not secure_compare(msg.hmac, expected_mac[:20]):
+        raise Exception("HMAC check failure")
 
-        output = (address_full[:address_len], message_full[:message_len])
-        out_queue += [output]
+    if replay_filter is not None:
+        replay_filter.add(key_material)
 
-    return sorted(out_queue)
+    ## Decrypt the address and the message
+    iv = b"\x00"*16
+
+    address_plaintext = aes_ctr_enc_dec(address_key, iv, msg.address)
+    message_plaintext = aes_ctr_enc_dec(message_key, iv, msg.message)
+
+    # Decode the address and message
+    address_len, address_full = unpack("!H256s", address_plaintext)
+    message_len, message_full = unpack("!H1000s", message_plaintext)
+
+    return (address_full[:address_len], message_full[:message_len])
         
         
 def mix_client_one_hop(public_key, address, message):
@@ -152,7 +169,7 @@ NHopMixMessage = namedtuple('NHopMixMessage', ['ec_public_key',
                                                    'message'])
 
 
-def mix_server_n_hop(private_key, message_list, final=False):
+def mix_server_n_hop(private_key, message_list, final=False, replay_filter=None):
     """ Decodes a NHopMixMessage message and outputs either messages destined
     to the next mix or a list of tuples (address, message) (if final=True) to be 
     sent to their final recipients.
@@ -162,83 +179,179 @@ def mix_server_n_hop(private_key, message_list, final=False):
         - checks the first hmac,
         - decrypts all other parts,
         - either forwards or decodes the message. 
+
+    Optionally, messages already seen by the replay_filter are dropped.
     """
 
     G = EcGroup()
+    round_filter = _RoundReplays(replay_filter) if replay_filter is not None else None
 
     out_queue = []
 
     # Process all messages
     for msg in message_list:
+        out_msg = _mix_n_hop_decode(G, private_key, msg, final, round_filter)
+        if out_msg is not None:
+            out_queue += [out_msg]
 
-        ## Check elements and lengths
-        if not G.check_point(msg.ec_public_key) or \
-               not isinstance(msg.hmacs, list) or \
-               not len(msg.hmacs[0]) == 20 or \
-               not len(msg.address) == 258 or \
-               not len(msg.message) == 1002:
-           raise Exception("Malformed input message")
-
-        ## First get a shared key
-        shared_element = private_key * msg.ec_public_key
-        key_material = sha512(shared_element.export()).digest()
-
-        # Use different parts of the shared key for different operations
-        hmac_key = key_material[:16]
-        address_key = key_material[16:32]
-        message_key = key_material[32:48]
-
-        # Extract a blinding factor for the public_key
-        blinding_factor = Bn.from_binary(key_material[48:])
-        new_ec_public_key = blinding_factor * msg.ec_public_key
+    if round_filter is not None:
+        round_filter.commit()
+    return out_queue
 
-        ## Check the HMAC
-        h = Hmac(b"sha512", hmac_key)
+def _mix_n_hop_decode(G, private_key, msg, final, replay_filter=None):
+    """ Decodes a single NHopMixMessage into either the NHopMixMessage for the
+    next mix or an (address, message) tuple (if final=True), or None if the
+    replay_filter has seen it before. """
 
-        for other_mac in msg.hmacs[1:]:
-            h.update(other_mac)
+    ## Check elements and lengths
+    if not G.check_point(msg.ec_public_key) or \
+           not isinstance(msg.hmacs, list) or \
+           not len(msg.hmacs[0]) == 20 or \
+           not len(msg.address) == 258 or \
+           not len(msg.message) == 1002:
+       raise Exception("Malformed input message")
 
-        h.update(msg.address)
-        h.update(msg.message)
+    ## First get a shared key
+    shared_element = private_key * msg.ec_public_key
+    key_material = sha512(shared_element.export()).digest()
 
-        expected_mac = h.digest()
+    # Drop replays before doing any more work
+    if replay_filter is not None and key_material in replay_filter:
+        return None
 
-        if not secure_compare(msg.hmacs[0], expected_mac[:20]):
-            raise Exception("HMAC check failure")
+    # Use different parts of the shared key for different operations
+    hmac_key = key_material[:16]
+    address_key = key_material[16:32]
+    message_key = key_material[32:48]
 
-        ## Decrypt the hmacs, address and the message
-        aes = Cipher("AES-128-CTR") 
+    # Extract a blinding factor for the public_key
+    blinding_factor = Bn.from_binary(key_material[48:])
+    new_ec_public_key = blinding_factor * msg.ec_public_key
 
-        # Decrypt hmacs
-        new_hmacs = []
-        for i, other_mac in enumerate(msg.hmacs[1:]):
-            # Ensure the IV is different for each hmac
-            iv = pack("H14s", i, b"\x00"*14)
+    ## Check the HMAC
+    h = Hmac(b"sha512", hmac_key)
 
-            hmac_plaintext = aes_ctr_enc_dec(hmac_key, iv, other_mac)
-            new_hmacs += [hmac_plaintext]
+    for other_mac in msg.hmacs[1:]:
+        h.update(other_mac)
 
-        # Decrypt address & message
-        iv = b"\x00"*16
-        
-        address_plaintext = aes_ctr_enc_dec(address_key, iv, msg.address)
-        message_plaintext = aes_ctr_enc_dec(message_key, iv, msg.message)
+    h.update(msg.address)
+    h.update(msg.message)
 
-        if final:
-            # Decode the address and message
-            address_len, address_full = unpack("!H256s", address_plaintext)
-            message_len, message_full = unpack("!H1000s", message_plaintext)
+    expected_mac = h.digest()
 
-            out_msg = (address_full[:address_len], message_full[:message_len])
-            out_queue += [out_msg]
-        else:
-            # Pass the new mix message to the next mix
-            out_msg = NHopMixMessage(new_ec_public_key, new_hmacs, address_plaintext, message_plaintext)
-            out_queue += [out_msg]
+    if not secure_compare(msg.hmacs[0], expected_mac[:20]):
+        raise Exception("HMAC check failure")
 
-    return out_queue
+    if replay_filter is not None:
+        replay_filter.add(key_material)
+
+    ## Decrypt the hmacs, address and the message
+    new_hmacs, address_plaintext, message_plaintext = mix_decrypt_fused(
+        hmac_key, address_key, message_key, msg.hmacs[1:], msg.address, msg.message)
+
+    if final:
+        # Decode the address and message
+        address_len, address_full = unpack("!H256s", address_plaintext)
+        message_len, message_full = unpack("!H1000s", message_plaintext)
+
+        out_msg = (address_full[:address_len], message_full[:message_len])
+    else:
+        # Pass the new mix message to the next mix
+        out_msg = NHopMixMessage(new_ec_public_key, new_hmacs, address_plaintext, message_plaintext)
+
+    return out_msg
 
 
+def mix_decrypt(hmac_key, address_key, message_key, hmacs, address, message):
+    """ Decrypts the hmacs, address and message of a NHopMixMessage, part
+    by part, with aes_ctr_enc_dec. Returns (hmacs, address, message). """
+
+    # Decrypt hmacs
+    new_hmacs = []
+    for i, other_mac in enumerate(hmacs):
+        # Ensure the IV is different for each hmac
+        iv = pack("H14s", i, b"\x00"*14)
+
+        hmac_plaintext = aes_ctr_enc_dec(hmac_key, iv, other_mac)
+        new_hmacs += [hmac_plaintext]
+
+    # Decrypt address & message
+    iv = b"\x00"*16
+    
+    address_plaintext = aes_ctr_enc_dec(address_key, iv, address)
+    message_plaintext = aes_ctr_enc_dec(message_key, iv, message)
+
+    return new_hmacs, address_plaintext, message_plaintext
+
+## Fused decryption.
+#  mix_decrypt builds a cipher context per hmac. The hmac with index i is
+#  encrypted in CTR mode from the counter block pack("H14s", i, zeros),
+#  so its keystream is the AES (ECB) encryption of that block and the
+#  following ones. All counter blocks of a packet are encrypted in one
+#  ECB pass, and all hmacs are decrypted with a single XOR over their
+#  concatenation. The cipher objects are created once per process.
+
+from binascii import unhexlify
+from timeit import default_timer as timer
+
+_AES_CTR = Cipher("AES-128-CTR")
+_AES_ECB = Cipher("AES-128-ECB")
+
+def _xor(a, b):
+    if not a:
+        return b""
+    x = int(hexlify(a), 16) ^ int(hexlify(b), 16)
+    return unhexlify("%0*x" % (2 * len(a), x))
+
+def _hmac_counter_blocks(hmacs):
+    blocks = []
+    for i, other_mac in enumerate(hmacs):
+        prefix = pack("H", i)
+        for j in range((len(other_mac) + 15) // 16):
+            blocks.append(prefix + pack("!6xQ", j))
+    return b"".join(blocks)
+
+def mix_decrypt_fused(hmac_key, address_key, message_key, hmacs, address, message):
+    """ Same as mix_decrypt, using one AES pass for all the hmacs and
+    cached cipher objects. """
+    new_hmacs = []
+    if hmacs:
+        keystream = _AES_ECB.enc(hmac_key, b"").update(_hmac_counter_blocks(hmacs))
+
+        pads = []
+        offset = 0
+        for other_mac in hmacs:
+            pads.append(keystream[offset:offset + len(other_mac)])
+            offset += 16 * ((len(other_mac) + 15) // 16)
+        plain = _xor(b"".join(hmacs), b"".join(pads))
+
+        offset = 0
+        for other_mac in hmacs:
+            new_hmacs.append(plain[offset:offset + len(other_mac)])
+            offset += len(other_mac)
+
+    iv = b"\x00"*16
+    address_plaintext = _AES_CTR.enc(address_key, iv).update(address)
+    message_plaintext = _AES_CTR.enc(message_key, iv).update(message)
+
+    return new_hmacs, address_plaintext, message_plaintext
+
+def time_mix_decrypt(hops=10, repetitions=2000):
+    """ Compares the per-packet microseconds of mix_decrypt and
+    mix_decrypt_fused, for a packet with hops - 1 encrypted hmacs. """
+    from os import urandom
+    keys = [urandom(16) for _ in range(3)]
+    hmacs = [urandom(20) for _ in range(hops - 1)]
+    address, message = urandom(258), urandom(1002)
+
+    results = {}
+    for name, decrypt in [("before", mix_decrypt), ("after", mix_decrypt_fused)]:
+        start = timer()
+        for _ in range(repetitions):
+            decrypt(keys[0], keys[1], keys[2], hmacs, address, message)
+        results[name + "_microseconds"] = (timer() - start) * 1e6 / repetitions
+    return results
+
 def mix_client_n_hop(public_keys, address, message):
     """
     Encode a message to travel through a sequence of mixes with a sequence public keys. 
@@ -267,6 +380,752 @@ def mix_client_n_hop(public_keys, address, message):
 
 
 
+#####################################################
+# TASK 3 (cont.) -- Parallel batch processing
+#           A mix receives large batches of packets per round, and
+#           each packet costs a scalar multiplication, a hash, an
+#           HMAC and AES passes. The parallel servers split a batch
+#           into chunks, decode them in a pool of processes, and
+#           keep the output order of the serial servers. Packets
+#           cross process boundaries in the binary wire encoding (see
+#           below), since petlib objects cannot be pickled.
+
+import multiprocessing
+from petlib.ec import EcPt, POINT_CONVERSION_UNCOMPRESSED
+
+MIX_CHUNK_SIZE = 256
+
+def _mix_job(job):
+    kind, private_key, chunk, final = job
+    G = EcGroup()
+    private_key = Bn.from_binary(private_key)
+
+    out = []
+    for msg in decode_packets(G, chunk):
+        if kind == "one_hop":
+            out += [_mix_one_hop_decode(G, private_key, msg)]
+        else:
+            out += [_mix_n_hop_decode(G, private_key, msg, final)]
+
+    if kind == "n_hop" and not final:
+        return encode_packets(out, compressed=False)
+    return out
+
+def _mix_parallel(kind, private_key, message_list, final, processes, chunk_size):
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    message_list = list(message_list)
+    jobs = [(kind, private_key.binary(),
+             encode_packets(message_list[i:i + chunk_size], compressed=False), final)
+            for i in range(0, len(message_list), chunk_size)]
+
+    G = EcGroup()
+    pool = multiprocessing.Pool(processes)
+    try:
+        out_queue = []
+        for out in pool.imap(_mix_job, jobs):
+            if kind == "n_hop" and not final:
+                out = decode_packets(G, out)
+            out_queue += out
+    finally:
+        pool.close()
+        pool.join()
+
+    return out_queue
+
+def mix_server_one_hop_parallel(private_key, message_list, processes=None,
+                                chunk_size=MIX_CHUNK_SIZE):
+    """ Same as mix_server_one_hop, but decodes the messages with a pool
+    of processes (default: one per core). """
+    return sorted(_mix_parallel("one_hop", private_key, message_list, False,
+                                processes, chunk_size))
+
+def mix_server_n_hop_parallel(private_key, message_list, final=False, processes=None,
+                              chunk_size=MIX_CHUNK_SIZE):
+    """ Same as mix_server_n_hop, but decodes the messages with a pool
+    of processes (default: one per core). The output keeps the input order. """
+    return _mix_parallel("n_hop", private_key, message_list, final,
+                         processes, chunk_size)
+
+def time_mix_servers(private_key, message_list, n_hop=False, max_processes=None):
+    """ Reports the packets/sec of the serial mix server and of the parallel
+    one with 1 up to max_processes (default: the number of cores) processes,
+    for a list of packets encoded for private_key. """
+    if max_processes is None:
+        max_processes = multiprocessing.cpu_count()
+
+    if n_hop:
+        serial, parallel = mix_server_n_hop, mix_server_n_hop_parallel
+    else:
+        serial, parallel = mix_server_one_hop, mix_server_one_hop_parallel
+
+    start = timer()
+    serial(private_key, message_list)
+    results = {"serial": len(message_list) / (timer() - start)}
+
+    for n in range(1, max_processes + 1):
+        start = timer()
+        parallel(private_key, message_list, processes=n)
+        results["parallel_%d_processes" % n] = len(message_list) / (timer() - start)
+    return results
+
+
+#####################################################
+# TASK 3 (cont.) -- Streaming threshold / pool mix
+#           Instead of a whole round in a list, the streaming mix
+#           consumes an iterator of packets, decodes each one as it
+#           arrives and holds the results in a bounded pool. When the
+#           pool reaches the threshold, or the oldest held packet has
+#           waited for the timeout, a shuffled batch is flushed; a pool
+#           mix keeps `retain` random packets back for the next batch.
+#           The source may yield None when no packet has arrived, so
+#           that timeouts fire on an idle link.
+
+def mix_stream_n_hop(private_key, packets, threshold=100, retain=0, timeout=None,
+                     final=False, on_error=None, clock=timer, rand=None,
+                     replay_filter=None):
+    """ Decodes a stream of NHopMixMessage packets, yielding shuffled
+    lists of outputs (as mix_server_n_hop would return them). At most
+    threshold outputs are ever held. Packets that fail to decode are
+    dropped and passed with their exception to on_error, if given, and
+    replays seen by the replay_filter are dropped. """
+    if not 0 <= retain < threshold:
+        raise Exception("The pool must retain fewer packets than the threshold")
+    if rand is None:
+        rand = random.SystemRandom()
+
+    G = EcGroup()
+    pool = []
+    oldest = None
+
+    def flush():
+        rand.shuffle(pool)
+        batch = pool[retain:]
+        del pool[retain:]
+        return batch
+
+    for msg in packets:
+        now = clock()
+        if msg is not None:
+            try:
+                out_msg = _mix_n_hop_decode(G, private_key, msg, final, replay_filter)
+                if out_msg is not None:
+                    pool.append(out_msg)
+                    if oldest is None:
+                        oldest = now
+            except Exception as e:
+                if on_error is not None:
+                    on_error(msg, e)
+
+        timed_out = timeout is not None and oldest is not None and now - oldest >= timeout
+        if len(pool) >= threshold or (timed_out and len(pool) > retain):
+            yield flush()
+            # Retained packets restart their wait with the next batch
+            oldest = now if pool else None
+
+    if pool:
+        rand.shuffle(pool)
+        yield pool
+
+
+#####################################################
+# TASK 3 (cont.) -- Sphinx-style packet format
+#           The NHopMixMessage header grows with the path, and every
+#           mix decrypts all the remaining hmacs. A SphinxMixMessage
+#           instead carries a header of SPHINX_MAX_HOPS fixed-size
+#           slots, whatever the path length. Each slot holds a flag
+#           and a 20 byte MAC. A mix checks the MAC of the header and
+#           of the payload it received, decrypts the header (shifting
+#           in keystream at the end) and reads the next slot, which is
+#           either the MAC for the next mix or, at the last mix, the
+#           MAC of the decrypted payload. A filler computed by the
+#           client keeps every MAC valid after the shifts. The payload
+#           (address and message) is encrypted in CTR mode once per
+#           mix; since every mix authenticates it, a payload tagged on
+#           its way in is dropped by the first mix it reaches.
+
+SphinxMixMessage = namedtuple('SphinxMixMessage', ['ec_public_key',
+                                                   'hmac',
+                                                   'header',
+                                                   'payload'])
+
+SPHINX_MAX_HOPS = 10
+SPHINX_SLOT_LEN = 21
+SPHINX_HEADER_LEN = SPHINX_MAX_HOPS * SPHINX_SLOT_LEN
+SPHINX_PAYLOAD_LEN = 258 + 1002
+
+SPHINX_FORWARD = b"\x00"
+SPHINX_FINAL = b"\x01"
+
+def _sphinx_keys(key_material):
+    hmac_key = key_material[:16]
+    header_key = key_material[16:32]
+    payload_key = key_material[32:48]
+    blinding_factor = Bn.from_binary(key_material[48:])
+    return hmac_key, header_key, payload_key, blinding_factor
+
+def _sphinx_mac(hmac_key, data):
+    h = Hmac(b"sha512", hmac_key)
+    h.update(data)
+    return h.digest()[:20]
+
+def _keystream(key, length):
+    return _AES_CTR.enc(key, b"\x00"*16).update(b"\x00"*length)
+
+def mix_client_sphinx(public_keys, address, message):
+    """
+    Encode a message to travel through a sequence of up to SPHINX_MAX_HOPS
+    mixes with a sequence of public keys. The maximum size of the final
+    address and the message are 256 bytes and 1000 bytes respectively.
+    Returns a 'SphinxMixMessage' with a public key, an hmac (20 bytes),
+    a header (SPHINX_HEADER_LEN bytes) and a payload (258 + 1002 bytes).
+    """
+    G = EcGroup()
+    assert 1 <= len(public_keys) <= SPHINX_MAX_HOPS
+    assert isinstance(address, bytes) and len(address) <= 256
+    assert isinstance(message, bytes) and len(message) <= 1000
+
+    payload = pack("!H256s", len(address), address) + pack("!H1000s", len(message), message)
+
+    ## Generate a fresh public key
+    private_key = G.order().random()
+    client_public_key  = private_key * G.generator()
+
+    ## Derive the keys of every mix, following the blinding of the public key
+    keys = []
+    blinding = private_key
+    for public_key in public_keys:
+        key_material = sha512((blinding * public_key).export()).digest()
+        hmac_key, header_key, payload_key, blinding_factor = _sphinx_keys(key_material)
+        keys += [(hmac_key, header_key, payload_key)]
+        blinding = (blinding * blinding_factor) % G.order()
+
+    ## The filler: what mixes 1..n-1 will see shifted into the end of the header
+    L, k, n = SPHINX_HEADER_LEN, SPHINX_SLOT_LEN, len(public_keys)
+    filler = b""
+    for i in range(1, n):
+        stream = _keystream(keys[i - 1][1], L + k)
+        filler = _xor(filler + b"\x00"*k, stream[L + k - i*k:])
+
+    ## The payload as each mix receives it: payloads[i] is encrypted for mixes i..n-1
+    payloads = [None] * n + [payload]
+    for i in reversed(range(n)):
+        payloads[i] = _xor(payloads[i + 1], _keystream(keys[i][2], SPHINX_PAYLOAD_LEN))
+
+    ## Build the header from the last mix backwards
+    hmac_key, header_key, payload_key = keys[-1]
+    last_slot = SPHINX_FINAL + _sphinx_mac(hmac_key, payload)
+    padding = b"\x00" * (L - n*k)
+    header = _xor(last_slot + padding, _keystream(header_key, L - (n - 1)*k)) + filler
+    mac = _sphinx_mac(hmac_key, header + payloads[n - 1])
+
+    for i in reversed(range(n - 1)):
+        hmac_key, header_key, payload_key = keys[i]
+        slot = SPHINX_FORWARD + mac
+        header = _xor(slot + header[:L - k], _keystream(header_key, L))
+        mac = _sphinx_mac(hmac_key, header + payloads[i])
+
+    payload = payloads[0]
+    return SphinxMixMessage(client_public_key, mac, header, payload)
+
+def _mix_sphinx_decode(G, private_key, msg, replay_filter=None):
+    """ Decodes a single SphinxMixMessage into either the SphinxMixMessage for
+    the next mix or an (address, message) tuple at the last mix, or None if
+    the replay_filter has seen it before. """
+
+    ## Check elements and lengths
+    if not G.check_point(msg.ec_public_key) or \
+           not len(msg.hmac) == 20 or \
+           not len(msg.header) == SPHINX_HEADER_LEN or \
+           not len(msg.payload) == SPHINX_PAYLOAD_LEN:
+       raise Exception("Malformed input message")
+
+    ## First get a shared key
+    key_material = sha512((private_key * msg.ec_public_key).export()).digest()
+
+    # Drop replays before doing any more work
+    if replay_filter is not None and key_material in replay_filter:
+        return None
+
+    hmac_key, header_key, payload_key, blinding_factor = _sphinx_keys(key_material)
+
+    ## Check the HMAC of the header and payload
+    if not secure_compare(msg.hmac, _sphinx_mac(hmac_key, msg.header + msg.payload)):
+        raise Exception("HMAC check failure")
+
+    if replay_filter is not None:
+        replay_filter.add(key_material)
+
+    ## Decrypt the header, read our slot, and decrypt the payload
+    k = SPHINX_SLOT_LEN
+    header = _xor(msg.header + b"\x00"*k, _keystream(header_key, SPHINX_HEADER_LEN + k))
+    flag, next_mac, new_header = header[:1], header[1:k], header[k:]
+    payload = _xor(msg.payload, _keystream(payload_key, SPHINX_PAYLOAD_LEN))
+
+    if flag == SPHINX_FORWARD:
+        new_ec_public_key = blinding_factor * msg.ec_public_key
+        return SphinxMixMessage(new_ec_public_key, next_mac, new_header, payload)
+
+    if flag != SPHINX_FINAL:
+        raise Exception("Malformed routing information")
+
+    if not secure_compare(next_mac, _sphinx_mac(hmac_key, payload)):
+        raise Exception("Payload HMAC check failure")
+
+    # Decode the address and message
+    address_len, address_full = unpack("!H256s", payload[:258])
+    message_len, message_full = unpack("!H1000s", payload[258:])
+    return (address_full[:address_len], message_full[:message_len])
+
+def mix_server_sphinx(private_key, message_list, replay_filter=None):
+    """ Decodes a list of SphinxMixMessage messages. The header tells each
+    mix whether it is the last one: the output holds the messages for the
+    next mix, and (address, message) tuples for the final recipients.
+    Optionally, messages already seen by the replay_filter are dropped. """
+    G = EcGroup()
+    round_filter = _RoundReplays(replay_filter) if replay_filter is not None else None
+
+    out_queue = []
+
+    # Process all messages
+    for msg in message_list:
+        out_msg = _mix_sphinx_decode(G, private_key, msg, round_filter)
+        if out_msg is not None:
+            out_queue += [out_msg]
+
+    if round_filter is not None:
+        round_filter.commit()
+    return out_queue
+
+def _packet_size(msg):
+    size = 0
+    for part in msg:
+        if isinstance(part, list):
+            size += sum(len(p) for p in part)
+        elif isinstance(part, bytes):
+            size += len(part)
+        else:
+            size += len(part.export())
+    return size
+
+def time_packet_formats(max_hops=SPHINX_MAX_HOPS, repetitions=50, n_hop_client=None):
+    """ For 1 to max_hops hops, reports the bytes on the wire and the
+    microseconds the first mix spends on a packet, for the NHopMixMessage
+    and SphinxMixMessage formats. n_hop_client defaults to mix_client_n_hop;
+    its packets only need to be valid for the first mix. """
+    if n_hop_client is None:
+        n_hop_client = mix_client_n_hop
+
+    G = EcGroup()
+    private_keys = [G.order().random() for _ in range(max_hops)]
+    public_keys = [pk * G.generator() for pk in private_keys]
+
+    results = []
+    for hops in range(1, max_hops + 1):
+        row = {"hops": hops}
+        for name, client, decode in [
+                ("n_hop", n_hop_client, lambda m: _mix_n_hop_decode(G, private_keys[0], m, hops == 1)),
+                ("sphinx", mix_client_sphinx, lambda m: _mix_sphinx_decode(G, private_keys[0], m))]:
+            packets = [client(public_keys[:hops], b"Alice", b"Hello") for _ in range(repetitions)]
+
+            start = timer()
+            for msg in packets:
+                decode(msg)
+            row[name + "_microseconds"] = (timer() - start) * 1e6 / repetitions
+            row[name + "_bytes"] = _packet_size(packets[0])
+        results.append(row)
+    return results
+
+
+#####################################################
+# TASK 3 (cont.) -- Binary wire encoding
+#           Packets have a fixed binary layout, so that they can be
+#           moved between processes or spooled to disk without pickling:
+#
+#           type (1 byte) | point length (1 byte) | point |
+#           hmac count (1 byte) | hmacs (20 bytes each) | body
+#
+#           The body is the address (258) and message (1002) of the
+#           OneHopMixMessage and NHopMixMessage types, and the header and
+#           payload of SphinxMixMessage. Points are compressed by default;
+#           uncompressed points are 28 bytes longer on P-224 but about a
+#           hundred times cheaper to decode, which suits local IPC.
+#           Parsing walks a memoryview of the buffer, so only the fields
+#           themselves are copied out (the petlib bindings need bytes).
+
+import os
+
+PACKET_ONE_HOP = 1
+PACKET_N_HOP = 2
+PACKET_SPHINX = 3
+
+_PACKET_BODY = {
+    PACKET_ONE_HOP: (258, 1002),
+    PACKET_N_HOP: (258, 1002),
+    PACKET_SPHINX: (SPHINX_HEADER_LEN, SPHINX_PAYLOAD_LEN),
+}
+
+def encode_packet(msg, compressed=True):
+    """ Encodes a OneHopMixMessage, NHopMixMessage or SphinxMixMessage into bytes. """
+    if isinstance(msg, SphinxMixMessage):
+        kind, hmacs, body = PACKET_SPHINX, [msg.hmac], [msg.header, msg.payload]
+    elif isinstance(msg, NHopMixMessage):
+        kind, hmacs, body = PACKET_N_HOP, msg.hmacs, [msg.address, msg.message]
+    elif isinstance(msg, OneHopMixMessage):
+        kind, hmacs, body = PACKET_ONE_HOP, [msg.hmac], [msg.address, msg.message]
+    else:
+        raise Exception("Unknown packet type")
+
+    if compressed:
+        point = msg.ec_public_key.export()
+    else:
+        point = msg.ec_public_key.export(POINT_CONVERSION_UNCOMPRESSED)
+
+    if len(hmacs) > 255 or any(len(h) != 20 for h in hmacs) or \
+           [len(b) for b in body] != list(_PACKET_BODY[kind]):
+        raise Exception("Malformed input message")
+
+    return b"".join([pack("!BB", kind, len(point)), point, pack("!B", len(hmacs))] + hmacs + body)
+
+def decode_packet(G, buf, offset=0):
+    """ Decodes the packet starting at offset in buf (bytes, bytearray or
+    memoryview). Returns the packet and the offset just after it. """
+    view = memoryview(buf)
+    try:
+        kind, point_len = unpack_from("!BB", view, offset)
+        offset += 2
+        point = EcPt.from_binary(view[offset:offset + point_len].tobytes(), G)
+        offset += point_len
+        count, = unpack_from("!B", view, offset)
+        offset += 1
+        body_lens = _PACKET_BODY[kind]
+    except Exception:
+        raise Exception("Malformed input message")
+
+    fields = []
+    for length in [20] * count + list(body_lens):
+        if offset + length > len(view):
+            raise Exception("Malformed input message")
+        fields.append(view[offset:offset + length].tobytes())
+        offset += length
+
+    hmacs, (first, second) = fields[:count], fields[count:]
+    if kind == PACKET_N_HOP:
+        msg = NHopMixMessage(point, hmacs, first, second)
+    elif count != 1:
+        raise Exception("Malformed input message")
+    elif kind == PACKET_ONE_HOP:
+        msg = OneHopMixMessage(point, hmacs[0], first, second)
+    else:
+        msg = SphinxMixMessage(point, hmacs[0], first, second)
+
+    return msg, offset
+
+def encode_packets(packets, compressed=True):
+    """ Encodes a batch of packets into one buffer. """
+    return b"".join(encode_packet(msg, compressed) for msg in packets)
+
+def decode_packets(G, buf):
+    """ Decodes all the packets in a buffer made by encode_packets. """
+    view = memoryview(buf)
+    packets = []
+    offset = 0
+    while offset < len(view):
+        msg, offset = decode_packet(G, view, offset)
+        packets.append(msg)
+    return packets
+
+def write_packets(filename, packets, compressed=True):
+    """ Spools a batch of packets to a file. """
+    with open(filename, "wb") as f:
+        f.write(encode_packets(packets, compressed))
+
+def read_packets(filename, G=None):
+    """ Reads back a batch of packets written by write_packets. """
+    if G is None:
+        G = EcGroup()
+    with open(filename, "rb") as f:
+        buf = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(buf)
+    return decode_packets(G, buf)
+
+def time_packet_encoding(packets, compressed=(True, False), repetitions=5):
+    """ Reports the packets/sec and MB/s to encode and decode a batch of packets. """
+    G = EcGroup()
+    results = []
+    for c in compressed:
+        start = timer()
+        for _ in range(repetitions):
+            buf = encode_packets(packets, c)
+        encode_time = (timer() - start) / repetitions
+
+        start = timer()
+        for _ in range(repetitions):
+            decode_packets(G, buf)
+        decode_time = (timer() - start) / repetitions
+
+        results.append({"compressed": c,
+                        "bytes": len(buf),
+                        "encode_packets_per_second": len(packets) / encode_time,
+                        "decode_packets_per_second": len(packets) / decode_time,
+                        "encode_mb_per_second": len(buf) / encode_time / 1e6,
+                        "decode_mb_per_second": len(buf) / decode_time / 1e6})
+    return results
+
+
+#####################################################
+# TASK 3 (cont.) -- Multi-process cascade simulator
+#           Each mix of a cascade runs in its own process, connected
+#           to the next one by a bounded queue carrying batches in the
+#           wire encoding. The report gives the end-to-end throughput,
+#           the latency of each hop (time from entering its queue to
+#           leaving the mix) and the depth of its input queue, to find
+#           the bottleneck hop. The client and server are arguments,
+#           so that other packet formats can be simulated; they must
+#           be module-level functions to reach the worker processes.
+
+def _percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+def _queue_depth(queue):
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
+
+def _cascade_hop(hop, private_key, server, final, in_queue, out_queue, stats_queue):
+    G = EcGroup()
+    private_key = Bn.from_binary(private_key)
+    latencies, processing, depths = [], [], []
+    error = None
+
+    while True:
+        item = in_queue.get()
+        if item is None:
+            out_queue.put(None)
+            break
+        if error is not None:
+            # Keep draining, so that the previous hops do not block
+            continue
+        depths.append(_queue_depth(in_queue))
+
+        enqueued, buf = item
+        start = timer()
+        try:
+            out = server(private_key, decode_packets(G, buf), final)
+            if not final:
+                out = encode_packets(out, compressed=False)
+        except Exception as e:
+            error = str(e)
+            continue
+        end = timer()
+
+        out_queue.put((end, out))
+        latencies.append(end - enqueued)
+        processing.append(end - start)
+
+    stats_queue.put((hop, latencies, processing, depths, error))
+
+def run_cascade(private_keys, messages, client=None, server=None,
+                batch_size=100, queue_size=8):
+    """ Sends the (address, message) pairs through a cascade of mixes, one
+    process per private key. client(public_keys, address, message) encodes
+    a packet (default: mix_client_n_hop) and server(private_key, message_list,
+    final) runs a mix (default: mix_server_n_hop). Returns the outputs of the
+    last mix and a report of the throughput, latencies and queue depths. """
+    if client is None:
+        client = mix_client_n_hop
+    if server is None:
+        server = mix_server_n_hop
+
+    G = EcGroup()
+    public_keys = [pk * G.generator() for pk in private_keys]
+
+    start = timer()
+    packets = [client(public_keys, address, message) for address, message in messages]
+    client_seconds = timer() - start
+
+    queues = [multiprocessing.Queue(queue_size) for _ in private_keys]
+    queues.append(multiprocessing.Queue())
+    stats_queue = multiprocessing.Queue()
+
+    hops = [multiprocessing.Process(target=_cascade_hop,
+                                    args=(i, pk.binary(), server, i == len(private_keys) - 1,
+                                          queues[i], queues[i + 1], stats_queue))
+            for i, pk in enumerate(private_keys)]
+    for p in hops:
+        p.start()
+
+    start = timer()
+    for i in range(0, len(packets), batch_size):
+        queues[0].put((timer(), encode_packets(packets[i:i + batch_size], compressed=False)))
+    queues[0].put(None)
+
+    outputs = []
+    while True:
+        item = queues[-1].get()
+        if item is None:
+            break
+        outputs += item[1]
+    seconds = timer() - start
+
+    stats = sorted(stats_queue.get() for _ in hops)
+    for p in hops:
+        p.join()
+
+    for hop, _, _, _, error in stats:
+        if error is not None:
+            raise Exception("Hop %d failed: %s" % (hop, error))
+
+    report = {"packets": len(packets),
+              "client_seconds": client_seconds,
+              "seconds": seconds,
+              "packets_per_second": len(packets) / seconds if seconds else None,
+              "hops": []}
+    for hop, latencies, processing, depths, _ in stats:
+        depths = [d for d in depths if d is not None]
+        report["hops"].append({
+            "hop": hop,
+            "batches": len(latencies),
+            "latency_p50": _percentile(latencies, 50),
+            "latency_p90": _percentile(latencies, 90),
+            "latency_p99": _percentile(latencies, 99),
+            "processing_p50": _percentile(processing, 50),
+            "processing_p99": _percentile(processing, 99),
+            "max_queue_depth": max(depths) if depths else None,
+            "mean_queue_depth": float(sum(depths)) / len(depths) if depths else None})
+
+    return outputs, report
+
+
+#####################################################
+# TASK 3 (cont.) -- Replay detection
+#           A mix must not process the same packet twice, or an
+#           adversary could replay a packet and watch where the copy
+#           goes. The servers can be given a replay filter, checked with
+#           the derived key_material right after the scalar multiplication
+#           and before any HMAC or AES work; packets pass the HMAC check
+#           before they are added. The list servers only add the packets
+#           of a round once the whole round is decoded, so that a round
+#           lost to an exception can be sent again. The filter is a Bloom filter made of
+#           two generations: entries go into the current one, lookups
+#           check both, and the older one is dropped whenever an epoch
+#           ends or the current one holds capacity entries. Memory is
+#           bounded, and an entry is remembered for at least one epoch
+#           (mixes are expected to rotate keys at least as often).
+
+import math
+
+class ReplayFilter(object):
+    """ A rotating Bloom filter of byte strings, holding up to capacity
+    entries per epoch with a false positive rate of about error_rate. """
+
+    def __init__(self, capacity=1000000, error_rate=1e-6, epoch_seconds=3600, clock=timer):
+        if capacity < 1 or not 0 < error_rate < 1:
+            raise Exception("Invalid replay filter parameters")
+
+        # Both generations are checked, so each gets half of the error rate
+        p = error_rate / 2
+        self.num_bits = int(math.ceil(-capacity * math.log(p) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / capacity * math.log(2))))
+        self.capacity = capacity
+        self.epoch_seconds = epoch_seconds
+        self.clock = clock
+
+        self._current = bytearray((self.num_bits + 7) // 8)
+        self._previous = bytearray((self.num_bits + 7) // 8)
+        self._count = 0
+        self._epoch_start = clock()
+
+    def _positions(self, item):
+        # Double hashing: the i-th position is h1 + i * h2
+        h1, h2 = unpack("!QQ", sha512(item).digest()[:16])
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def _rotate_if_due(self):
+        if self._count >= self.capacity or \
+               (self.epoch_seconds is not None and
+                self.clock() - self._epoch_start >= self.epoch_seconds):
+            self.rotate()
+
+    def rotate(self):
+        """ Starts a new epoch, forgetting the entries of the previous one. """
+        self._previous = self._current
+        self._current = bytearray(len(self._previous))
+        self._count = 0
+        self._epoch_start = self.clock()
+
+    def add(self, item):
+        self._rotate_if_due()
+        for pos in self._positions(item):
+            self._current[pos >> 3] |= 1 << (pos & 7)
+        self._count += 1
+
+    def __contains__(self, item):
+        self._rotate_if_due()
+        positions = self._positions(item)
+        for bits in (self._current, self._previous):
+            if all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+                return True
+        return False
+
+    def memory_bytes(self):
+        """ The memory used by the bit arrays of both generations. """
+        return len(self._current) + len(self._previous)
+
+class _RoundReplays(object):
+    """ Holds back the entries added during a round, and only adds them to
+    the replay_filter on commit. Replays within the round are still seen. """
+
+    def __init__(self, replay_filter):
+        self.replay_filter = replay_filter
+        self._pending = set()
+
+    def add(self, item):
+        self._pending.add(item)
+
+    def __contains__(self, item):
+        return item in self._pending or item in self.replay_filter
+
+    def commit(self):
+        for item in self._pending:
+            self.replay_filter.add(item)
+        self._pending = set()
+
+def time_replay_filter(entries=100000, error_rate=1e-6, lookups=100000):
+    """ Reports the memory per million entries and the cost of adds and
+    lookups of a ReplayFilter, its measured false positive rate, and the
+    memory of a plain set of 64 byte keys for comparison. """
+    import sys
+    from os import urandom
+
+    replay_filter = ReplayFilter(capacity=entries, error_rate=error_rate, epoch_seconds=None)
+    items = [urandom(64) for _ in range(entries)]
+    others = [urandom(64) for _ in range(lookups)]
+
+    start = timer()
+    for item in items:
+        replay_filter.add(item)
+    add_time = timer() - start
+
+    start = timer()
+    false_positives = sum(1 for item in others if item in replay_filter)
+    lookup_time = timer() - start
+
+    seen = set(items)
+    set_bytes = sys.getsizeof(seen) + sum(sys.getsizeof(item) for item in items)
+
+    return {"filter_bytes_per_million": replay_filter.memory_bytes() * 1e6 / entries,
+            "set_bytes_per_million": set_bytes * 1e6 / entries,
+            "add_microseconds": add_time * 1e6 / entries,
+            "lookup_microseconds": lookup_time * 1e6 / lookups,
+            "false_positive_rate": float(false_positives) / lookups}
+
+
 #####################################################
 # TASK 4 -- Statistical Disclosure Attack
 #           Given a set of anonymized traces
@@ -0,0 +1,227 @@
+#####################################################
+# GA17 Privacy Enhancing Technologies -- Lab 02
+#
+# An asyncio mix node, running the Lab02Code mix servers
+# as a network service.
+#
+# This module needs Python 3 (asyncio), so it is kept apart
+# from Lab02Code.py, which must stay importable on Python 2.
+
+import asyncio
+import random
+from concurrent.futures import ProcessPoolExecutor
+from struct import pack, unpack
+
+from petlib.ec import EcGroup, Bn
+
+from Lab02Code import mix_server_n_hop, encode_packet, decode_packet, \
+    SPHINX_HEADER_LEN, SPHINX_PAYLOAD_LEN
+
+#####################################################
+# Framing and round processing
+#
+# Packets travel over a stream in the Lab02Code wire encoding, each
+# preceded by its length (4 bytes). A round of packets is decoded,
+# mixed and re-encoded by _process_round, which only takes and returns
+# bytes, so it can run in a thread or in a process pool executor.
+# No packet in the wire encoding is longer than MAX_FRAME_LEN, and
+# longer frames are rejected before anything is buffered.
+
+FRAME_HEADER_LEN = 4
+MAX_FRAME_LEN = 3 + 255 + 255 * 20 + max(258 + 1002, SPHINX_HEADER_LEN + SPHINX_PAYLOAD_LEN)
+
+def frame(packet):
+    """ Prefixes an encoded packet with its length. """
+    return pack("!I", len(packet)) + packet
+
+async def read_frame(reader):
+    """ Reads one framed packet, or returns None at the end of the stream.
+    Throws an exception if the frame is longer than MAX_FRAME_LEN. """
+    try:
+        header = await reader.readexactly(FRAME_HEADER_LEN)
+        length, = unpack("!I", header)
+        if length > MAX_FRAME_LEN:
+            raise Exception("Frame too long")
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+def _process_round(private_key, packets, final, server, replay_filter=None):
+    """ Mixes a round of encoded packets. Returns the outputs (encoded
+    packets, or (address, message) tuples if final) and the number of
+    packets dropped. Each packet is decoded and mixed once, on its own,
+    so a bad packet only drops itself, not the round. If a replay_filter
+    is given, it is passed on to the server. """
+    G = EcGroup()
+    private_key = Bn.from_binary(private_key)
+
+    options = {} if replay_filter is None else {"replay_filter": replay_filter}
+    out = []
+    for packet in packets:
+        try:
+            msg = decode_packet(G, packet)[0]
+            out += server(private_key, [msg], final, **options)
+        except Exception:
+            pass
+
+    dropped = len(packets) - len(out)
+    if not final:
+        out = [encode_packet(msg, compressed=False) for msg in out]
+    return out, dropped
+
+async def open_stream(address):
+    """ Connects to a (host, port) pair or a Unix socket path. """
+    if isinstance(address, tuple):
+        return await asyncio.open_connection(*address)
+    return await asyncio.open_unix_connection(address)
+
+async def send_packets(address, packets):
+    """ Sends encoded packets to the mix node listening at address. """
+    reader, writer = await open_stream(address)
+    for packet in packets:
+        writer.write(frame(packet))
+        await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+#####################################################
+# The mix node
+#
+# Connections put packets in a bounded queue. When it is full, reading
+# stops, and TCP flow control pushes back on the senders. A batching
+# task collects rounds of up to round_size packets (or whatever arrived
+# within round_timeout of the first one), mixes them in an executor so
+# that the event loop stays responsive, shuffles the outputs and writes
+# them to the next hop, waiting for it to drain. At the last hop the
+# outputs are passed to deliver(address, message). A round that fails
+# (next hop unreachable, deliver raising) is lost and counted, and the
+# node carries on with the next one.
+#
+# A replay_filter is passed to the server for every packet. It lives in
+# the node's process, so it needs the default thread executor: a process
+# pool would only update copies of it.
+
+class MixNode(object):
+    """ A mix listening for packets, processing them in rounds. """
+
+    def __init__(self, private_key, next_hop=None, deliver=None,
+                 server=mix_server_n_hop, round_size=100, round_timeout=1.0,
+                 max_queue=1000, executor=None, replay_filter=None):
+        if (next_hop is None) == (deliver is None):
+            raise Exception("A mix node needs either a next hop or a deliver callback")
+        if replay_filter is not None and isinstance(executor, ProcessPoolExecutor):
+            raise Exception("A replay filter cannot be shared with a process pool")
+        self.private_key = private_key.binary()
+        self.next_hop = next_hop
+        self.deliver = deliver
+        self.server = server
+        self.round_size = round_size
+        self.round_timeout = round_timeout
+        self.executor = executor
+        self.replay_filter = replay_filter
+
+        self.stats = {"received": 0, "processed": 0, "dropped": 0, "rounds": 0,
+                      "failed_rounds": 0, "failed_connections": 0}
+        self._queue = asyncio.Queue(max_queue)
+        self._servers = []
+        self._batcher = None
+        self._writer = None
+        self._rand = random.SystemRandom()
+
+    async def start(self, host="127.0.0.1", port=0):
+        """ Listens on a TCP port (0: any free one), returns the (host, port) used. """
+        server = await asyncio.start_server(self._handle, host, port)
+        self._servers.append(server)
+        self._start_batcher()
+        return server.sockets[0].getsockname()[:2]
+
+    async def start_unix(self, path):
+        """ Listens on a Unix socket. """
+        self._servers.append(await asyncio.start_unix_server(self._handle, path))
+        self._start_batcher()
+        return path
+
+    def _start_batcher(self):
+        if self._batcher is None:
+            self._batcher = asyncio.ensure_future(self._run_rounds())
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                packet = await read_frame(reader)
+                if packet is None:
+                    break
+                self.stats["received"] += 1
+                await self._queue.put(packet)
+        except Exception:
+            # Oversized frames or a reset connection: close it quietly
+            self.stats["failed_connections"] += 1
+        finally:
+            writer.close()
+
+    async def _next_round(self):
+        loop = asyncio.get_event_loop()
+        packets = [await self._queue.get()]
+        deadline = loop.time() + self.round_timeout
+        while len(packets) < self.round_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                packets.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return packets
+
+    async def _run_rounds(self):
+        loop = asyncio.get_event_loop()
+        final = self.next_hop is None
+        while True:
+            packets = await self._next_round()
+            try:
+                out, dropped = await loop.run_in_executor(
+                    self.executor, _process_round, self.private_key, packets, final,
+                    self.server, self.replay_filter)
+
+                self._rand.shuffle(out)
+                if final:
+                    for address, message in out:
+                        self.deliver(address, message)
+                else:
+                    await self._forward(out)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Lose this round, but keep the node running; the next
+                # round reconnects to the next hop.
+                self.stats["failed_rounds"] += 1
+                self._close_writer()
+                continue
+
+            self.stats["rounds"] += 1
+            self.stats["processed"] += len(out)
+            self.stats["dropped"] += dropped
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def _forward(self, packets):
+        if self._writer is None:
+            _, self._writer = await open_stream(self.next_hop)
+        self._writer.write(b"".join(frame(packet) for packet in packets))
+        await self._writer.drain()
+
+    async def close(self):
+        """ Stops listening and processing. Queued packets are discarded. """
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+        self._close_writer()
@@ -188,6 +188,519 @@ def test_Alice_encode_3_hop():
     assert out[0][0] == address
     assert out[0][1] == message
 
+@pytest.mark.task3
+def test_fused_decryption():
+    """
+    The fused decryption must agree with the part by part one
+    """
+    from os import urandom
+
+    for hops in [1, 2, 3, 10]:
+        keys = [urandom(16) for _ in range(3)]
+        hmacs = [urandom(20) for _ in range(hops - 1)]
+        address, message = urandom(258), urandom(1002)
+
+        expected = mix_decrypt(keys[0], keys[1], keys[2], hmacs, address, message)
+        assert mix_decrypt_fused(keys[0], keys[1], keys[2], hmacs, address, message) == expected
+
+    # Other hmac lengths use more (or fewer) keystream blocks
+    hmacs = [urandom(n) for n in [0, 5, 16, 33]]
+    expected = mix_decrypt(keys[0], keys[1], keys[2], hmacs, address, message)
+    assert mix_decrypt_fused(keys[0], keys[1], keys[2], hmacs, address, message) == expected
+
+###########################################
+## TASK 3 (cont.) -- Parallel batch processing
+
+from os import urandom
+
+def single_mix_packet(public_key, address, message, other_hmacs=None):
+    """
+    Build a packet for the mix holding public_key directly from the
+    packet format, so that the servers can be tested on their own.
+    Returns a NHopMixMessage if other_hmacs is given (a list of 20 byte
+    strings, decrypted and forwarded by the mix), or a OneHopMixMessage.
+    """
+    from hashlib import sha512
+    from struct import pack
+    from petlib.hmac import Hmac
+
+    G = EcGroup()
+    private_key = G.order().random()
+    key_material = sha512((private_key * public_key).export()).digest()
+
+    iv = b"\x00"*16
+    address_cipher = aes_ctr_enc_dec(key_material[16:32], iv, pack("!H256s", len(address), address))
+    message_cipher = aes_ctr_enc_dec(key_material[32:48], iv, pack("!H1000s", len(message), message))
+
+    h = Hmac(b"sha512", key_material[:16])
+    for other_mac in (other_hmacs or []):
+        h.update(other_mac)
+    h.update(address_cipher)
+    h.update(message_cipher)
+    mac = h.digest()[:20]
+
+    client_public_key = private_key * G.generator()
+    if other_hmacs is None:
+        return OneHopMixMessage(client_public_key, mac, address_cipher, message_cipher)
+    return NHopMixMessage(client_public_key, [mac] + other_hmacs, address_cipher, message_cipher)
+
+@pytest.fixture
+def mix_batch():
+    G = EcGroup()
+    private_key = G.order().random()
+    public_key = private_key * G.generator()
+
+    addresses = [urandom(10) for _ in range(7)]
+    one_hop = [single_mix_packet(public_key, a, b"Hello") for a in addresses]
+    n_hop = [single_mix_packet(public_key, a, b"Hello", [urandom(20), urandom(20)])
+             for a in addresses]
+    return private_key, one_hop, n_hop
+
+@pytest.mark.task3
+def test_parallel_one_hop(mix_batch):
+    private_key, one_hop, _ = mix_batch
+
+    expected = mix_server_one_hop(private_key, one_hop)
+    assert len(expected) == 7
+    assert mix_server_one_hop_parallel(private_key, one_hop, processes=2, chunk_size=3) == expected
+
+    bad = one_hop[:3] + [one_hop[3]._replace(hmac=urandom(20))]
+    with raises(Exception) as excinfo:
+        mix_server_one_hop_parallel(private_key, bad, processes=2, chunk_size=2)
+    assert 'HMAC check failure' in str(excinfo.value)
+
+@pytest.mark.task3
+def test_parallel_n_hop(mix_batch):
+    private_key, _, n_hop = mix_batch
+
+    expected = mix_server_n_hop(private_key, n_hop)
+    out = mix_server_n_hop_parallel(private_key, n_hop, processes=2, chunk_size=3)
+    assert out == expected
+
+    final = mix_server_n_hop_parallel(private_key, n_hop, final=True, processes=2, chunk_size=3)
+    assert final == mix_server_n_hop(private_key, n_hop, final=True)
+
+@pytest.mark.task3
+def test_stream_threshold(mix_batch):
+    private_key, _, n_hop = mix_batch
+    expected = mix_server_n_hop(private_key, n_hop, final=True)
+
+    batches = list(mix_stream_n_hop(private_key, iter(n_hop), threshold=3, final=True))
+    assert [len(b) for b in batches] == [3, 3, 1]
+    assert sorted(sum(batches, [])) == sorted(expected)
+
+    # A pool mix holds packets back, but loses none
+    batches = list(mix_stream_n_hop(private_key, iter(n_hop), threshold=3, retain=1, final=True))
+    assert [len(b) for b in batches] == [2, 2, 2, 1]
+    assert sorted(sum(batches, [])) == sorted(expected)
+
+    with raises(Exception) as excinfo:
+        next(mix_stream_n_hop(private_key, iter(n_hop), threshold=3, retain=3))
+    assert 'fewer packets' in str(excinfo.value)
+
+@pytest.mark.task3
+def test_stream_timeout(mix_batch):
+    private_key, _, n_hop = mix_batch
+    times = iter(range(100))
+    errors = []
+
+    bad = n_hop[1]._replace(hmacs=[urandom(20)] + n_hop[1].hmacs[1:])
+    source = [n_hop[0], bad, None, None, n_hop[2], n_hop[3], None]
+    stream = mix_stream_n_hop(private_key, iter(source), threshold=10, timeout=3,
+                              final=True, on_error=lambda msg, e: errors.append(e),
+                              clock=lambda: next(times))
+
+    assert [len(b) for b in stream] == [1, 2]
+    assert len(errors) == 1 and 'HMAC check failure' in str(errors[0])
+
+###########################################
+## TASK 3 (cont.) -- Sphinx-style packet format
+
+@pytest.fixture
+def sphinx_cascade():
+    G = EcGroup()
+    private_keys = [G.order().random() for _ in range(10)]
+    public_keys = [pk * G.generator() for pk in private_keys]
+    return private_keys, public_keys
+
+@pytest.mark.task3
+def test_sphinx_hops(sphinx_cascade):
+    private_keys, public_keys = sphinx_cascade
+    address = b"Alice"
+    message = b"Dear Alice,\nHello!\nBob"
+
+    for hops in [1, 3, 10]:
+        out = [mix_client_sphinx(public_keys[:hops], address, message)]
+        for private_key in private_keys[:hops]:
+            assert len(out[0].header) == SPHINX_HEADER_LEN
+            out = mix_server_sphinx(private_key, out)
+
+        assert out == [(address, message)]
+
+    with raises(Exception):
+        mix_client_sphinx(public_keys + public_keys[:1], address, message)
+
+@pytest.mark.task3
+def test_sphinx_fails(sphinx_cascade):
+    private_keys, public_keys = sphinx_cascade
+    m1 = mix_client_sphinx(public_keys[:2], b"Alice", b"Hello")
+
+    with raises(Exception) as excinfo:
+        mix_server_sphinx(private_keys[1], [m1])
+    assert 'HMAC check failure' in str(excinfo.value)
+
+    bad_header = m1._replace(header=m1.header[:-1] + b"X")
+    with raises(Exception) as excinfo:
+        mix_server_sphinx(private_keys[0], [bad_header])
+    assert 'HMAC check failure' in str(excinfo.value)
+
+    # Payload tampering is detected by the first mix
+    flipped = m1.payload[:-1] + bytes(bytearray([bytearray(m1.payload)[-1] ^ 1]))
+    with raises(Exception) as excinfo:
+        mix_server_sphinx(private_keys[0], [m1._replace(payload=flipped)])
+    assert 'HMAC check failure' in str(excinfo.value)
+
+    # ... and by later mixes too
+    out = mix_server_sphinx(private_keys[0], [m1])
+    with raises(Exception) as excinfo:
+        mix_server_sphinx(private_keys[1], [out[0]._replace(payload=urandom(SPHINX_PAYLOAD_LEN))])
+    assert 'HMAC check failure' in str(excinfo.value)
+
+    with raises(Exception) as excinfo:
+        mix_server_sphinx(private_keys[0], [m1._replace(header=m1.header[1:])])
+    assert 'Malformed input message' in str(excinfo.value)
+
+@pytest.mark.task3
+def test_time_packet_formats():
+    def n_hop_client(public_keys, address, message):
+        return single_mix_packet(public_keys[0], address, message,
+                                 [urandom(20) for _ in public_keys[1:]])
+
+    results = time_packet_formats(max_hops=3, repetitions=2, n_hop_client=n_hop_client)
+    assert [r["hops"] for r in results] == [1, 2, 3]
+    assert [r["n_hop_bytes"] for r in results] == [29 + 20*n + 1260 for n in (1, 2, 3)]
+    assert all(r["sphinx_bytes"] == 29 + 20 + SPHINX_HEADER_LEN + 1260 for r in results)
+
+###########################################
+## TASK 3 (cont.) -- Binary wire encoding
+
+@pytest.mark.task3
+def test_wire_encoding(sphinx_cascade):
+    private_keys, public_keys = sphinx_cascade
+    G = EcGroup()
+
+    packets = [single_mix_packet(public_keys[0], b"Alice", b"Hello"),
+               single_mix_packet(public_keys[0], b"Bob", b"Hello", [urandom(20), urandom(20)]),
+               single_mix_packet(public_keys[0], b"Charlie", b"Hello", []),
+               mix_client_sphinx(public_keys[:3], b"Dave", b"Hello")]
+
+    for compressed, point_len in [(True, 29), (False, 57)]:
+        buf = encode_packets(packets, compressed)
+        assert len(encode_packet(packets[0], compressed)) == 3 + point_len + 20 + 1260
+        assert decode_packets(G, buf) == packets
+
+        # Parsing from an offset into a larger buffer
+        view = memoryview(b"junk" + buf)
+        msg, offset = decode_packet(G, view, 4)
+        assert msg == packets[0] and offset == 4 + len(encode_packet(packets[0], compressed))
+
+    for bad in [buf[:-1], buf + b"\x07", b"\x09" + buf[1:]]:
+        with raises(Exception) as excinfo:
+            decode_packets(G, bad)
+        assert 'Malformed input message' in str(excinfo.value)
+
+    with raises(Exception) as excinfo:
+        encode_packet(packets[0]._replace(hmac=b"short"))
+    assert 'Malformed input message' in str(excinfo.value)
+
+@pytest.mark.task3
+def test_wire_files(tmpdir, sphinx_cascade):
+    private_keys, public_keys = sphinx_cascade
+    messages = [urandom(100) for _ in range(5)]
+    packets = [mix_client_sphinx(public_keys[:2], b"Alice", m) for m in messages]
+
+    filename = str(tmpdir.join("spool.bin"))
+    write_packets(filename, packets)
+    assert read_packets(filename) == packets
+
+    out = mix_server_sphinx(private_keys[0], read_packets(filename))
+    write_packets(filename, out, compressed=False)
+    out = mix_server_sphinx(private_keys[1], read_packets(filename))
+    assert out == [(b"Alice", m) for m in messages]
+
+###########################################
+## TASK 3 (cont.) -- Multi-process cascade simulator
+
+def sphinx_server(private_key, message_list, final, replay_filter=None):
+    return mix_server_sphinx(private_key, message_list, replay_filter=replay_filter)
+
+def reversed_sphinx_client(public_keys, address, message):
+    return mix_client_sphinx(public_keys[::-1], address, message)
+
+@pytest.mark.task3
+def test_run_cascade(sphinx_cascade):
+    private_keys, public_keys = sphinx_cascade
+    messages = [(b"Alice", urandom(50)) for _ in range(25)]
+
+    outputs, report = run_cascade(private_keys[:3], messages, client=mix_client_sphinx,
+                                  server=sphinx_server, batch_size=10, queue_size=2)
+
+    assert outputs == messages
+    assert report["packets"] == 25 and report["packets_per_second"] > 0
+    assert [h["hop"] for h in report["hops"]] == [0, 1, 2]
+    for h in report["hops"]:
+        assert h["batches"] == 3
+        assert h["latency_p50"] <= h["latency_p99"]
+        assert h["processing_p50"] <= h["latency_p99"]
+
+    # A failing mix is reported instead of stalling the cascade
+    with raises(Exception) as excinfo:
+        run_cascade(private_keys[:2], messages, client=reversed_sphinx_client,
+                    server=sphinx_server, batch_size=1, queue_size=1)
+    assert 'Hop 0 failed: HMAC check failure' in str(excinfo.value)
+
+###########################################
+## TASK 3 (cont.) -- asyncio mix node (Lab02Node.py)
+
+import sys
+
+@pytest.mark.task3
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="The mix node needs asyncio")
+def test_mix_node_cascade(sphinx_cascade, tmpdir):
+    import asyncio
+    from Lab02Node import MixNode, send_packets
+
+    private_keys, public_keys = sphinx_cascade
+    messages = [(b"Alice", urandom(50)) for _ in range(12)]
+    packets = [encode_packet(mix_client_sphinx(public_keys[:2], a, m)) for a, m in messages]
+    bad = encode_packet(mix_client_sphinx(public_keys[1:3], b"Eve", b"Bad"))
+
+    delivered = []
+
+    async def run():
+        last = MixNode(private_keys[1], deliver=lambda a, m: delivered.append((a, m)),
+                       server=sphinx_server, round_size=5, round_timeout=0.2)
+        path = await last.start_unix(str(tmpdir.join("mix.sock")))
+        first = MixNode(private_keys[0], next_hop=path, server=sphinx_server,
+                        round_size=5, round_timeout=0.2, max_queue=2)
+        address = await first.start()
+
+        await send_packets(address, packets[:6] + [bad, b"garbage"] + packets[6:])
+        for _ in range(100):
+            if len(delivered) == len(messages):
+                break
+            await asyncio.sleep(0.05)
+
+        await first.close()
+        await last.close()
+        return first.stats, last.stats
+
+    first_stats, last_stats = asyncio.run(run())
+
+    assert sorted(delivered) == sorted(messages)
+    assert first_stats["received"] == 14 and first_stats["dropped"] == 2
+    assert last_stats["processed"] == 12 and last_stats["rounds"] >= 3
+
+@pytest.mark.task3
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="The mix node needs asyncio")
+def test_process_round_mixes_each_packet_once(sphinx_cascade):
+    from Lab02Node import _process_round
+
+    private_keys, public_keys = sphinx_cascade
+    packets = [encode_packet(mix_client_sphinx(public_keys[:1], b"Alice", urandom(50)))
+               for _ in range(4)]
+    bad = encode_packet(mix_client_sphinx(public_keys[1:2], b"Eve", b"Bad"))
+    calls = []
+
+    def counting_server(private_key, message_list, final):
+        calls.extend(message_list)
+        return sphinx_server(private_key, message_list, final)
+
+    out, dropped = _process_round(private_keys[0].binary(), packets[:2] + [bad, b"garbage"] + packets[2:],
+                                  True, counting_server)
+    assert len(out) == 4 and dropped == 2
+    assert len(calls) == 5
+
+@pytest.mark.task3
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="The mix node needs asyncio")
+def test_mix_node_replay_filter(sphinx_cascade):
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+    from Lab02Node import MixNode, send_packets
+
+    private_keys, public_keys = sphinx_cascade
+    packets = [encode_packet(mix_client_sphinx(public_keys[:1], b"Alice", urandom(50)))
+               for _ in range(4)]
+    bad = encode_packet(mix_client_sphinx(public_keys[1:2], b"Eve", b"Bad"))
+    delivered = []
+
+    async def run():
+        node = MixNode(private_keys[0], deliver=lambda a, m: delivered.append((a, m)),
+                       server=sphinx_server, round_size=5, round_timeout=0.2,
+                       replay_filter=ReplayFilter(capacity=1000))
+        address = await node.start()
+        await send_packets(address, packets[:2] + [bad] + packets[2:])
+        await send_packets(address, packets[:2])
+        for _ in range(100):
+            if node.stats["processed"] + node.stats["dropped"] == 7:
+                break
+            await asyncio.sleep(0.05)
+        await node.close()
+        return node.stats
+
+    stats = asyncio.run(run())
+    assert len(delivered) == 4
+    assert stats["processed"] == 4 and stats["dropped"] == 3
+
+    with raises(Exception) as excinfo:
+        with ProcessPoolExecutor(1) as pool:
+            MixNode(private_keys[0], deliver=print, executor=pool,
+                    replay_filter=ReplayFilter(capacity=1000))
+    assert 'process pool' in str(excinfo.value)
+
+@pytest.mark.task3
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="The mix node needs asyncio")
+def test_mix_node_survives_failed_rounds(sphinx_cascade, tmpdir):
+    import asyncio
+    from Lab02Node import MixNode, send_packets
+
+    private_keys, public_keys = sphinx_cascade
+    packets = [encode_packet(mix_client_sphinx(public_keys[:2], b"Alice", b"Hello"))
+               for _ in range(4)]
+    missing = str(tmpdir.join("missing.sock"))
+
+    async def run():
+        node = MixNode(private_keys[0], next_hop=missing, server=sphinx_server,
+                       round_size=2, round_timeout=0.1)
+        address = await node.start()
+        await send_packets(address, packets)
+        for _ in range(100):
+            if node.stats["failed_rounds"] == 2:
+                break
+            await asyncio.sleep(0.05)
+
+        running = not node._batcher.done()
+        await node.close()
+        return running, node.stats
+
+    running, stats = asyncio.run(run())
+    assert running
+    assert stats["failed_rounds"] == 2 and stats["rounds"] == 0
+
+@pytest.mark.task3
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="The mix node needs asyncio")
+def test_mix_node_rejects_bad_frames(sphinx_cascade):
+    import asyncio
+    from struct import pack
+    from Lab02Node import MixNode, MAX_FRAME_LEN, send_packets
+
+    private_keys, public_keys = sphinx_cascade
+    packet = encode_packet(mix_client_sphinx(public_keys[:1], b"Alice", b"Hello"))
+    assert len(packet) <= MAX_FRAME_LEN
+    delivered = []
+
+    async def run():
+        node = MixNode(private_keys[0], deliver=lambda a, m: delivered.append((a, m)),
+                       server=sphinx_server, round_size=1, round_timeout=0.1)
+        address = await node.start()
+
+        # An oversized length is rejected without waiting for its body
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(pack("!I", 0xFFFFFFF0))
+        assert await asyncio.wait_for(reader.read(), 5) == b""
+        writer.close()
+
+        # A peer disconnecting in the middle of a frame
+        reader, writer = await asyncio.open_connection(*address)
+        writer.write(pack("!I", 100) + b"partial")
+        writer.close()
+
+        await send_packets(address, [packet])
+        for _ in range(100):
+            if delivered:
+                break
+            await asyncio.sleep(0.05)
+        await node.close()
+        return node.stats
+
+    stats = asyncio.run(run())
+    assert delivered == [(b"Alice", b"Hello")]
+    assert stats["failed_connections"] == 1 and stats["received"] == 1
+
+@pytest.mark.task3
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="The mix node needs asyncio")
+def test_mix_node_needs_a_destination():
+    from Lab02Node import MixNode
+    G = EcGroup()
+    with raises(Exception) as excinfo:
+        MixNode(G.order().random())
+    assert 'next hop or a deliver callback' in str(excinfo.value)
+
+###########################################
+## TASK 3 (cont.) -- Replay detection
+
+@pytest.mark.task3
+def test_replay_filter_rotation():
+    now = [0]
+    replay_filter = ReplayFilter(capacity=100, error_rate=1e-4, epoch_seconds=10,
+                                 clock=lambda: now[0])
+    items = [urandom(64) for _ in range(50)]
+    for item in items:
+        replay_filter.add(item)
+
+    assert all(item in replay_filter for item in items)
+    assert not any(urandom(64) in replay_filter for _ in range(100))
+
+    # Entries survive one rotation, but not two
+    now[0] = 10
+    assert all(item in replay_filter for item in items)
+    now[0] = 20
+    assert not any(item in replay_filter for item in items)
+
+    # Reaching the capacity also starts a new generation
+    for item in items + items:
+        replay_filter.add(item)
+    replay_filter.add(items[0])
+    assert replay_filter._count == 1 and items[1] in replay_filter
+
+    with raises(Exception) as excinfo:
+        ReplayFilter(error_rate=0)
+    assert 'Invalid replay filter' in str(excinfo.value)
+
+@pytest.mark.task3
+def test_replay_dropped(mix_batch, sphinx_cascade):
+    private_key, one_hop, n_hop = mix_batch
+
+    replay_filter = ReplayFilter(capacity=1000)
+    assert len(mix_server_one_hop(private_key, one_hop, replay_filter=replay_filter)) == 7
+    assert mix_server_one_hop(private_key, one_hop[:3], replay_filter=replay_filter) == []
+
+    # Packets failing the HMAC check are not remembered
+    bad = n_hop[0]._replace(hmacs=[urandom(20)] + n_hop[0].hmacs[1:])
+    replay_filter = ReplayFilter(capacity=1000)
+    with raises(Exception):
+        mix_server_n_hop(private_key, [bad], replay_filter=replay_filter)
+    out = mix_server_n_hop(private_key, n_hop + n_hop[:2], replay_filter=replay_filter)
+    assert out == mix_server_n_hop(private_key, n_hop)
+
+    stream = mix_stream_n_hop(private_key, iter(n_hop + n_hop), threshold=100,
+                              replay_filter=ReplayFilter(capacity=1000))
+    assert [len(b) for b in stream] == [7]
+
+    private_keys, public_keys = sphinx_cascade
+    m1 = mix_client_sphinx(public_keys[:1], b"Alice", b"Hello")
+    replay_filter = ReplayFilter(capacity=1000)
+    assert mix_server_sphinx(private_keys[0], [m1, m1], replay_filter=replay_filter) == [(b"Alice", b"Hello")]
+
+    # A round lost to a bad packet leaves nothing in the filter
+    m2 = mix_client_sphinx(public_keys[:1], b"Bob", b"Hi")
+    m3 = mix_client_sphinx(public_keys[:1], b"Eve", b"Bad")
+    bad = m3._replace(payload=urandom(len(m3.payload)))
+    replay_filter = ReplayFilter(capacity=1000)
+    with raises(Exception):
+        mix_server_sphinx(private_keys[0], [m1, m2, bad], replay_filter=replay_filter)
+    assert len(mix_server_sphinx(private_keys[0], [m1, m2], replay_filter=replay_filter)) == 2
+
 ###########################################
 ## TASK 4 -- Simple traffic analysis / SDA
 